@@ -4,18 +4,20 @@
 #             https://www.playframework.com/documentation/2.7.x/Evolutions
 # usage: ./evolutions.py <db_url> <db_user> <db_pass> <evolutions_dir>
 
-import glob, hashlib, logging, os.path as path, re, subprocess, sys
+import contextlib, copy, glob, hashlib, heapq, itertools, json, logging, math
+import os, os.path as path, random, re
+import queue, shlex, subprocess, sys, threading, time, zlib
 
 
-# Clean, uniform informational and error output
-logging.basicConfig(level='INFO', format='evolutions: %(message)s')
-logger = logging.getLogger()
+# Output is configured by main() when run as a script, otherwise left to the
+# embedding application
+logger = logging.getLogger('evolutions')
 
 
 # Holds a DB connection and info it was created from
 class DBConn:
     def __init__(self, db_type, cmd, host, port, db_name, user, pw, conn,
-                 param):
+                 param, engine='client', cmd_env=None):
         self.db_type = db_type
         self.cmd     = cmd
         self.host    = host
@@ -25,6 +27,17 @@ class DBConn:
         self.pw      = pw
         self.conn    = conn
         self.param   = param
+        self.cmd_env = cmd_env # Environment for cmd, None to inherit
+        self.opts    = Options() # Run settings (see parse_options())
+        self.opts.engine = engine
+        self.session_prefix = '' # Settings run at start of script sessions
+        self.running = None    # (idx, 'ups' or 'downs') of script running
+        self.stop_on_error = False # Client stops at first error (for retries)
+        self.profile = None    # Profile of statements run, if profiling
+        self.stage_hook = None # Called as hook(stage, which) after scripts
+        self.metrics = Metrics()
+        self.script_conn = None
+        self.connect = None    # Factory for further DB-API connections
 
     # Ugh, different DB-API2 impls use '?' or '%s' for parameter wildcard
     def fix_params(self, stmt):
@@ -36,76 +49,287 @@ class DBConn:
         db.execute(self.fix_params(stmt), *args)
         return db
 
-
-# Holds info on a single evolution stage (both ups and downs)
+    # Autocommit connection used by the 'dbapi' engine to run scripts, opened
+    # on first use.  Kept apart from conn so scripts run in their own session
+    # (as with the client) rather than inside the evolutions table lock.
+    # Sqlite's conn is already autocommit and has no lock, so it is shared.
+    def get_script_conn(self):
+        if self.script_conn is None:
+            if self.db_type == 'sqlite':
+                self.script_conn = self.conn
+            else:
+                self.script_conn = self.open_conn()
+        return self.script_conn
+
+    # Opens another autocommit connection to the database, or returns None
+    # if there is no way to (given just a connection by an application)
+    def open_conn(self):
+        if self.connect is not None:
+            conn = self.connect()
+            set_autocommit(conn, self.db_type, True)
+            return conn
+        if self.cmd is None:
+            return None
+        return open_dbapi(self.db_type, self.host, self.port, self.db_name,
+                          self.user, self.pw, True)
+
+    # Takes settings from a copy of command line Options, which may then be
+    # changed for this connection alone
+    def set_options(self, opts):
+        self.opts = copy.copy(opts)
+        if opts.profile:
+            # Statements are timed one by one, so run in-process
+            self.opts.engine = 'dbapi'
+            self.profile = Profile(opts.profile_top, opts.profile_explain)
+
+    # Closes the DB-API connection(s)
+    def close(self):
+        if self.script_conn is not None and self.script_conn is not self.conn:
+            self.script_conn.close()
+        self.script_conn = None
+        self.conn.close()
+
+
+# Collects durations (in seconds) of phases of a run and of scripts run
+class Metrics:
+    def __init__(self):
+        self.phases = {}
+        self.stages = [] # (idx, 'ups' or 'downs', seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0) +
+                                 time.perf_counter() - start)
+
+    def as_dict(self):
+        return {'phases': { k: round(v, 6) for k, v in self.phases.items() },
+                'stages': [ {'stage': idx, 'direction': d,
+                             'seconds': round(secs, 6)}
+                            for idx, d, secs in self.stages ]}
+
+
+# Slowest statements (up to top) of each script run, with the EXPLAIN plan
+# of any DML statements taking over explain_ms milliseconds
+class Profile:
+    def __init__(self, top=10, explain_ms=None):
+        self.top = top
+        self.explain_ms = explain_ms
+        self.scripts = {} # (idx, direction) -> totals and heap of slowest
+        self.lock = threading.Lock() # Parallel blocks add concurrently
+
+    # Records statement (numbered n in its script) which took secs and
+    # affected rows (None if not known); explain() gives its plan, if wanted
+    def add(self, key, n, stmt, secs, rows, explain):
+        with self.lock:
+            script = self.scripts.setdefault(
+                key, {'statements': 0, 'seconds': 0.0, 'top': []})
+            script['statements'] += 1
+            script['seconds'] += secs
+            top = script['top']
+            if len(top) >= self.top and secs <= top[0][0]:
+                return
+        entry = {'statement_no': n, 'seconds': round(secs, 6), 'rows': rows,
+                 'sql': stmt if len(stmt) <= 2000 else stmt[0:2000] + '...'}
+        if self.explain_ms is not None and secs * 1000 >= self.explain_ms:
+            entry['plan'] = explain()
+        with self.lock:
+            heapq.heappush(top, (secs, script['statements'], entry))
+            if len(top) > self.top:
+                heapq.heappop(top)
+
+    def as_dict(self):
+        return [ {'stage': idx, 'direction': d,
+                  'statements': script['statements'],
+                  'seconds': round(script['seconds'], 6),
+                  'top': [ entry for _, _, entry in
+                           sorted(script['top'], reverse=True) ]}
+                 for (idx, d), script in self.scripts.items() ]
+
+
+# Holds info on a single evolution stage (both ups and downs).  Scripts can
+# be loaded lazily: pass None and a loader, called as loader(stage, 'apply')
+# or loader(stage, 'revert') the first time the script is needed.
 class Stage:
     def __init__(self, idx, apply_hash, revert_hash,
-                 apply_script, revert_script, applied_at):
+                 apply_script, revert_script, applied_at, loader=None):
         self.idx = idx
         self.apply_hash = apply_hash
         self.revert_hash = revert_hash
-        self.apply_script = apply_script
-        self.revert_script = revert_script
+        self.scripts = {}
+        if loader is None or apply_script is not None:
+            self.scripts['apply'] = apply_script
+        if loader is None or revert_script is not None:
+            self.scripts['revert'] = revert_script
         self.applied_at = applied_at
+        self.loader = loader
+        self.files = {} # For stages from dir: 'apply'/'revert' -> file name
+        self.file_hashes = {} # Raw hashes of files, if hashes normalized
+        self.parallel = {} # 'apply'/'revert' -> whether file has parallel blocks
+
+    def hash(self, which):
+        return self.apply_hash if which == 'apply' else self.revert_hash
+
+    # Hash to check file contents against
+    def file_hash(self, which):
+        return self.file_hashes.get(which) or self.hash(which)
+
+    def get_script(self, which):
+        if which not in self.scripts:
+            self.scripts[which] = self.loader(self, which)
+        return self.scripts[which]
+
+    # Script, without keeping it in memory if not already (nor changing the
+    # stage, which fleet mode shares across threads)
+    def read_script(self, which):
+        if which in self.scripts:
+            return self.scripts[which]
+        return self.loader(self, which)
+
+    @property
+    def apply_script(self):
+        return self.get_script('apply')
+
+    @property
+    def revert_script(self):
+        return self.get_script('revert')
 
     def __str__(self):
-        return 'Stage %d (apply len = %d, revert len = %d)' % (
-            self.idx, len(self.apply_script), len(self.revert_script))
+        lens = [ str(len(self.scripts[w] or '')) if w in self.scripts else '?'
+                 for w in ('apply', 'revert') ]
+        return 'Stage %d (apply len = %s, revert len = %s)' % (
+            self.idx, lens[0], lens[1])
 
 
-# Utility
-def read_textfile(fname):
-    with open(fname, 'r', encoding='utf-8') as f:
-        return f.read()
+# Opens a DB-API2 connection of given type
+def open_dbapi(db_type, host, port, db_name, user, pw, autocommit=False):
+    if db_type == 'mysql':
+        import mysql.connector
+        return mysql.connector.connect(user=user, password=pw,
+                                       host=host, port=port, database=db_name,
+                                       charset='utf8', autocommit=autocommit)
+    elif db_type == 'postgresql':
+        import psycopg2
+        conn = psycopg2.connect(user=user, password=pw,
+                                host=host, port=port, database=db_name)
+        conn.set_session(autocommit=autocommit)
+        return conn
+    elif db_type == 'sqlite':
+        import sqlite3
+        # Note: always autocommit, transactions are left to the scripts
+        return sqlite3.connect(db_name, isolation_level=None)
+    raise Exception("Unsupported database type: '" + db_type + "'")
 
 
-# Return DBConn wrapping DB-API2 conn (https://python.org/dev/peps/pep-0249/)
-def get_connection(url, user, pw):
+# Infers database type from the module of a DB-API2 connection
+def connection_db_type(conn):
+    module = type(conn).__module__
+    for prefix, db_type in [('sqlite3', 'sqlite'), ('psycopg', 'postgresql'),
+                            ('mysql', 'mysql')]:
+        if module.startswith(prefix):
+            return db_type
+    raise Exception("Unknown database type of connection from '" + module
+                    + "', pass db_type")
+
+
+# Autocommit setting of a DB-API2 connection, to be restored by
+# set_autocommit(); for sqlite it is the isolation level (None = autocommit)
+def get_autocommit(conn, db_type):
+    if db_type == 'sqlite':
+        return conn.isolation_level
+    return conn.autocommit
+
+
+def set_autocommit(conn, db_type, value):
+    if db_type == 'sqlite':
+        conn.isolation_level = None if value is True else value
+    else:
+        conn.autocommit = value
+
+
+# Splits DB URL into (db_type, host, port, db_name); host and port are None
+# for file (sqlite) URLs, and port if not given
+def parse_db_url(url):
     url_re = re.compile(r'([^:]+)://([^:]+)(:([0-9]+))?/(.+)')
     file_re = re.compile(r'([^:]+):(/.+)')
     match = url_re.match(url)
     if match:
-        db_type, host, port, db_name = (match.group(1), match.group(2),
-                                        match.group(4), match.group(5))
-    else:
-        match = file_re.match(url)
-        if match:
-            db_type, host, port, db_name = (match.group(1), None,
-                                            None, match.group(2))
-        else:
-            raise Exception("Unrecognized DB URL format: '" + url + "'")
+        return (match.group(1), match.group(2), match.group(4), match.group(5))
+    match = file_re.match(url)
+    if match:
+        return (match.group(1), None, None, match.group(2))
+    raise Exception("Unrecognized DB URL format: '" + url + "'")
+
+
+# Inverse of parse_db_url()
+def make_db_url(db_type, host, port, db_name):
+    if host is None:
+        return db_type + ':' + db_name
+    return db_type + '://' + host + (':' + port if port else '') + '/' + db_name
+
+
+# Return DBConn wrapping DB-API2 conn (https://python.org/dev/peps/pep-0249/)
+def get_connection(url, user, pw, engine='client'):
+    db_type, host, port, db_name = parse_db_url(url)
+    cmd_env = None
     if db_type == 'mysql':
-        import mysql.connector
         port = port or '3306'; # String because that's what match would have yielded
-        conn = mysql.connector.connect(user=user, password=pw,
-                                       host=host, port=port, database=db_name,
-                                       charset='utf8', autocommit=False)
         cmd = ['mysql', '-u', user, '--password='+pw, db_name]
         param = '%s'
     elif db_type == 'postgresql':
-        import psycopg2, os
         port = port or '5432'; # String because that's what match would have yielded
-        conn = psycopg2.connect(user=user, password=pw,
-                                host=host, port=port, database=db_name)
-        conn.set_session(autocommit=False)
-        os.environ['PGPASSWORD'] = pw # Password via env ins
+        cmd_env = dict(os.environ, PGPASSWORD=pw) # Password via env ins
         cmd = ['psql', '-h', host or 'localhost', '-p', port, '-U', user, db_name]
         param = '%s'
     elif db_type == 'sqlite':
-        import sqlite3
         # Note: URL is assumed to contain absolute path in this case
-        conn = sqlite3.connect(db_name, isolation_level=None)
         cmd = ['sqlite3', db_name]
         param = '?'
     else:
         raise Exception("Unsupported database type: '" + db_type + "'")
+    conn = open_dbapi(db_type, host, port, db_name, user, pw)
 
-    return DBConn(db_type, cmd, host, port, db_name, user, pw, conn, param)
+    return DBConn(db_type, cmd, host, port, db_name, user, pw, conn, param,
+                  engine, cmd_env)
 
 
 # Connects to database and ensures evolutions table present
-def connect_and_ensure(url, user, pw):
-    dbConn = get_connection(url, user, pw)
+def connect_and_ensure(url, user, pw, engine='client'):
+    dbConn = get_connection(url, user, pw, engine)
+    ensure_table(dbConn)
+    return dbConn
+
+
+# Wraps an already open DB-API2 connection as a DBConn for the 'dbapi'
+# engine; connect, if given, opens further connections to the same database
+def wrap_connection(conn, db_type=None, connect=None):
+    db_type = db_type or connection_db_type(conn)
+    param = '?' if db_type == 'sqlite' else '%s'
+    dbConn = DBConn(db_type, None, None, None, '(' + db_type + ' connection)',
+                    None, None, conn, param, 'dbapi')
+    dbConn.connect = connect
+    return dbConn
+
+
+# Name of the database a wrapped connection is to (for its lock and logs),
+# if it can tell
+def connection_db_name(dbConn):
+    if dbConn.db_type == 'sqlite':
+        names = [ row[2] for row in dbConn.execute('PRAGMA database_list')
+                  if row[1] == 'main' ]
+        name = names[0] if names else None
+    elif dbConn.db_type == 'mysql':
+        name = dbConn.execute('SELECT DATABASE()').fetchone()[0]
+    else:
+        name = dbConn.execute('SELECT current_database()').fetchone()[0]
+    return name or dbConn.db_name
+
+
+# Creates evolutions table if not present, or upgrades it
+def ensure_table(dbConn):
     dbConn.execute('''
       CREATE TABLE IF NOT EXISTS evolutions (
           id             INT NOT NULL PRIMARY KEY,
@@ -113,27 +337,146 @@ def connect_and_ensure(url, user, pw):
           apply_hash     VARCHAR(64) NOT NULL,
           revert_hash    VARCHAR(64) NOT NULL,
           apply_script   TEXT,
-          revert_script  TEXT )
+          revert_script  TEXT,
+          apply_ms       INT )
     ''')
 
-    # We lock access to evolutions table to prevent concurrent runs of
-    # evolutions from interfering. Not supported for sqlite since only
-    # full database lock is supported, but for same reason not an issue there.
+    # Add columns missing from tables created by older versions
+    if 'apply_ms' not in table_columns(dbConn, 'evolutions'):
+        try:
+            dbConn.execute('ALTER TABLE evolutions ADD COLUMN apply_ms INT')
+        except Exception:
+            # May have been added concurrently, check again
+            dbConn.conn.rollback()
+            if 'apply_ms' not in table_columns(dbConn, 'evolutions'):
+                raise
+        dbConn.conn.commit()
+
+
+# Names of table's columns (lower case)
+def table_columns(dbConn, table):
+    db = dbConn.execute('SELECT * FROM ' + table + ' WHERE 1 = 0')
+    db.fetchall()
+    return [ col[0].lower() for col in db.description ]
+
+
+# Key of Postgres advisory lock, and name of MySQL user-level lock (which
+# unlike Postgres' is server-wide, so includes the database name)
+pg_lock_key = zlib.crc32(b'evolutions')
+
+def mysql_lock_name(dbConn):
+    name = 'evolutions:' + dbConn.db_name
+    if len(name) > 64:
+        name = 'evolutions:' + hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return name
+
+
+# We lock to prevent concurrent runs of evolutions from interfering, using
+# advisory locks so that runs finding the database up to date can check
+# without waiting.  Waits up to dbConn.opts.lock_wait seconds (0 = don't wait).
+# Not supported for sqlite since only full database lock is supported, but
+# for same reason not an issue there.
+def acquire_lock(dbConn):
+    wait = dbConn.opts.lock_wait
     if dbConn.db_type == 'mysql':
-        dbConn.execute("LOCK TABLES evolutions WRITE")
+        res = dbConn.execute('SELECT GET_LOCK(_?, _?)',
+                             [mysql_lock_name(dbConn), wait]).fetchone()
+        locked = res[0] == 1
     elif dbConn.db_type == 'postgresql':
-        dbConn.execute("LOCK TABLE evolutions IN ACCESS EXCLUSIVE MODE NOWAIT")
-    return dbConn
+        if wait > 0:
+            # Session setting (SET LOCAL is ignored on autocommit connections
+            # given by embedding applications), restored afterwards
+            old = dbConn.execute('SHOW lock_timeout').fetchone()[0]
+            dbConn.execute("SELECT set_config('lock_timeout', _?, false)",
+                           ['%ds' % (wait)]).fetchone()
+            try:
+                dbConn.execute('SELECT pg_advisory_lock(_?)', [pg_lock_key])
+                locked = True
+            except Exception:
+                dbConn.conn.rollback()
+                locked = False
+            dbConn.execute("SELECT set_config('lock_timeout', _?, false)",
+                           [old]).fetchone()
+        else:
+            res = dbConn.execute('SELECT pg_try_advisory_lock(_?)',
+                                 [pg_lock_key]).fetchone()
+            locked = res[0]
+    else:
+        return
+    if not locked:
+        raise Exception('Could not lock evolutions within %d seconds' % (wait))
+    # Start new transaction to see changes committed while waiting
+    dbConn.conn.commit()
+
+
+def release_lock(dbConn):
+    if dbConn.db_type == 'mysql':
+        dbConn.execute('SELECT RELEASE_LOCK(_?)',
+                       [mysql_lock_name(dbConn)]).fetchone()
+    elif dbConn.db_type == 'postgresql':
+        dbConn.execute('SELECT pg_advisory_unlock(_?)',
+                       [pg_lock_key]).fetchone()
 
 
-# Sha1 of a file; use only with small files, else chunk it
-def sha1_file(fname):
+chunk_size = 1 << 20
+
+
+# Sha1 of a file, and whether it contains parallel blocks, read in chunks
+def scan_file(fname):
+    h = hashlib.sha1()
+    marker = parallel_marker.encode('utf-8')
+    found = False
+    tail = b''
     with open(fname, 'rb') as f:
-        return hashlib.sha1(f.read()).hexdigest()
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+            found = found or marker in tail + chunk
+            tail = chunk[-len(marker):]
+    return h.hexdigest(), found
+
+
+# Manifest caching file hashes: {path: [size, mtime_ns, sha1, parallel]},
+# where parallel is whether the file contains parallel blocks
+def load_manifest(fname):
+    try:
+        with open(fname, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == 2:
+            return data['files']
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+    return {}
+
+
+# Saves manifest atomically; failure (e.g. read-only fs) is not fatal
+def save_manifest(fname, files):
+    tmp = fname + '.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': 2, 'files': files}, f, sort_keys=True)
+        os.replace(tmp, fname)
+    except OSError as e:
+        logger.warning("Could not write manifest '%s': %s", fname, e)
 
 
-# Reads in and collects hashes for all evolutions files in a directory
-def scan_dir_stages(ev_dir):
+# Loader reading a dir stage's script, checking it is what was hashed
+def load_dir_script(stage, which):
+    fname = stage.files[which]
+    with open(fname, 'rb') as f:
+        data = f.read()
+    if hashlib.sha1(data).hexdigest() != stage.file_hash(which):
+        raise Exception("File '%s' changed while running evolutions" % (fname))
+    return data.decode('utf-8')
+
+
+# Collects hashes for all evolutions files in a directory, hashing in
+# parallel, and skipping files whose size and mtime match those in the
+# manifest (if given: a file, or a dict kept in memory).  Script text is
+# only read when needed; whether it has parallel blocks is noted as hashed.
+# ev_dir may also be a bundle (see build_bundle()).
+def scan_dir_stages(ev_dir, manifest=None):
+    if path.isfile(ev_dir):
+        return scan_bundle_stages(ev_dir)
     numeric_re = re.compile(r'([0-9]+)(-downs)?\.sql')
     sql_files = glob.glob(path.join(ev_dir, '*.sql'))
     ups = []
@@ -154,84 +497,1332 @@ def scan_dir_stages(ev_dir):
     if ups != downs:
         raise Exception("Ups and downs SQL files are not in correspondence.")
 
+    if isinstance(manifest, dict):
+        cached = manifest
+    else:
+        cached = load_manifest(manifest) if manifest else {}
+    entries = {}
+    hashes = {}
+    parallel = {}
+    todo = []
+    for idx in ups:
+        for fname in (path.join(ev_dir, str(idx) + '.sql'),
+                      path.join(ev_dir, str(idx) + '-downs.sql')):
+            st = os.stat(fname)
+            key = path.abspath(fname)
+            entry = cached.get(key)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                entries[key] = entry
+                hashes[fname] = entry[2]
+                parallel[fname] = entry[3]
+            else:
+                todo.append((fname, key, st))
+
+    if todo:
+        from concurrent.futures import ThreadPoolExecutor
+        # Don't cache files modified so recently that a further change could
+        # leave size and mtime the same
+        racy_ns = time.time_ns() - 2 * 10**9
+        with ThreadPoolExecutor() as pool:
+            for (fname, key, st), (h, par) in zip(
+                    todo, pool.map(scan_file, [t[0] for t in todo])):
+                hashes[fname] = h
+                parallel[fname] = par
+                if st.st_mtime_ns < racy_ns:
+                    entries[key] = [st.st_size, st.st_mtime_ns, h, par]
+    if manifest is not None and entries != cached:
+        if isinstance(manifest, dict):
+            manifest.clear()
+            manifest.update(entries)
+        else:
+            save_manifest(manifest, entries)
+
     stages = []
     for idx in ups:
         ups_f = path.join(ev_dir, str(idx) + '.sql')
         downs_f = path.join(ev_dir, str(idx) + '-downs.sql')
-        stages.append(Stage(idx, sha1_file(ups_f), sha1_file(downs_f),
-                            read_textfile(ups_f), read_textfile(downs_f), None))
+        stage = Stage(idx, hashes[ups_f], hashes[downs_f], None, None, None,
+                      load_dir_script)
+        stage.files = {'apply': ups_f, 'revert': downs_f}
+        stage.parallel = {'apply': parallel[ups_f], 'revert': parallel[downs_f]}
+        stages.append(stage)
+    return stages
+
+
+# Bundles: an evolutions directory packed into a single zip file, with an
+# index of its stages and their hashes (manifest.json), so that only the
+# index is read at startup.  Scripts are read, and checked against the
+# index, only if run.
+bundle_manifest = 'manifest.json'
+
+def build_bundle(ev_dir, fname):
+    import zipfile
+    stages = check_stages(scan_dir_stages(ev_dir), ev_dir)
+    if not stages:
+        raise Exception("No evolutions found in dir '" + ev_dir + "'")
+    manifest = {'version': 1, 'stages': [
+        {'idx': stage.idx,
+         'apply_hash': stage.apply_hash, 'revert_hash': stage.revert_hash,
+         'apply': path.basename(stage.files['apply']),
+         'revert': path.basename(stage.files['revert'])}
+        for stage in stages ]}
+    tmp = fname + '.tmp'
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(bundle_manifest, json.dumps(manifest, indent=1))
+        for stage in stages:
+            for which in ('apply', 'revert'):
+                zf.write(stage.files[which], path.basename(stage.files[which]))
+
+    # Files could have changed since they were hashed
+    try:
+        for stage in scan_bundle_stages(tmp):
+            stage.read_script('apply')
+            stage.read_script('revert')
+    except Exception:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, fname)
+    logger.info("Wrote %d stages to bundle '%s'", len(stages), fname)
+
+
+# Reads index of bundle (memory-mapped), giving stages loading their scripts
+# from it
+def scan_bundle_stages(fname):
+    import mmap, zipfile
+
+    # Memory-mapped file usable by zipfile (mmap is only seekable() from 3.13)
+    class MappedFile(mmap.mmap):
+        def seekable(self):
+            return True
+
+    with open(fname, 'rb') as f:
+        data = MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        zf = zipfile.ZipFile(data)
+        manifest = json.loads(zf.read(bundle_manifest).decode('utf-8'))
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise Exception("Not an evolutions bundle: '%s' (%s)" % (fname, e))
+    if manifest.get('version') != 1:
+        raise Exception("Unsupported evolutions bundle version in '%s'"
+                        % (fname))
+    names = set(zf.namelist())
+    entries = {}
+
+    def load_script(stage, which):
+        name = entries[stage.idx][which]
+        data = zf.read(name)
+        if hashlib.sha1(data).hexdigest() != stage.file_hash(which):
+            raise Exception("Bundle '%s' entry '%s' does not match its"
+                            " manifest" % (fname, name))
+        return data.decode('utf-8')
+
+    stages = []
+    for entry in manifest['stages']:
+        for which in ('apply', 'revert'):
+            if entry[which] not in names:
+                raise Exception("Bundle '%s' missing entry '%s'"
+                                % (fname, entry[which]))
+        entries[entry['idx']] = entry
+        stages.append(Stage(entry['idx'], entry['apply_hash'],
+                            entry['revert_hash'], None, None, None,
+                            load_script))
     return stages
 
 
+# Reads hashes of stages recorded in the database; script bodies are only
+# fetched if and when needed (i.e. to run downs)
 def scan_db_stages(dbConn):
     res = dbConn.execute('''
-        SELECT id, apply_hash, revert_hash, apply_script, revert_script, applied_at FROM evolutions ORDER BY id ASC;
+        SELECT id, apply_hash, revert_hash, applied_at FROM evolutions ORDER BY id ASC;
     ''')
 
+    def load_script(stage, which):
+        return load_db_script(stage.idx, which, dbConn)
+
     stages = []
     for row in res.fetchall():
-        stages.append(Stage(row[0], row[1], row[2], row[3], row[4], row[5]))
+        stages.append(Stage(row[0], row[1], row[2], None, None, row[3],
+                            load_script))
 
     return stages
 
 
-# Check if stages start with 1 and go in sequence, assuming sorted
-def check_stages(stages, src):
+# Fetches one stored script ('apply' or 'revert') for a stage, from the
+# evolutions table or (if NULL there) the script store
+def load_db_script(idx, which, dbConn):
+    res = dbConn.execute('SELECT ' + which + '_script, ' + which + '_hash'
+                         ' FROM evolutions WHERE id = _?', [idx])
+    row = res.fetchone()
+    if row is None:
+        raise Exception('Stage %d missing from evolutions table' % (idx))
+    if row[0] is None:
+        script = load_store_script(row[1], dbConn)
+        if script is None:
+            raise Exception('Stage %d %s script missing from evolutions_scripts'
+                            % (idx, which))
+        return script
+    if row[0].startswith(stored_ref_prefix):
+        raise Exception('Stage %d %s script was not stored (%s), and no'
+                        ' file with same hash found'
+                        % (idx, which, row[0][len(stored_ref_prefix):]))
+    return row[0]
+
+
+# Checks the downs scripts of DB stages can all be loaded (as by
+# load_db_script()) before any are run, so a run does not stop part way
+# through reverting
+def check_db_downs(stages, dbConn):
+    for stage in stages:
+        if stage.scripts.get('revert') is not None:
+            continue
+        row = dbConn.execute('SELECT revert_script IS NULL, revert_script'
+                             ' LIKE _?, revert_hash FROM evolutions'
+                             ' WHERE id = _?',
+                             [stored_ref_prefix + '%', stage.idx]).fetchone()
+        if row is None or row[1] or (
+                row[0] and load_store_script(row[2], dbConn, False) is None):
+            load_db_script(stage.idx, 'revert', dbConn) # Raises
+
+
+# Prefix of text stored in place of scripts over Options.store_limit bytes
+stored_ref_prefix = '-- evolutions: not stored: '
+
+
+# Script to store in evolutions table for a stage, or reference to it if
+# larger than store limit, to avoid loading it.  With the script store, it
+# is put there instead and None is returned.
+def stored_script(stage, which, dbConn):
+    h = stage.hash(which)
+    fname = stage.files.get(which)
+    if fname is not None:
+        size = path.getsize(fname)
+        if size > dbConn.opts.store_limit:
+            return '%s%d bytes, sha1 %s' % (stored_ref_prefix, size, h)
+    if dbConn.opts.script_store:
+        if load_store_script(h, dbConn, False) is None:
+            store_script(h, stage.read_script(which), dbConn)
+        return None
+    return stage.read_script(which)
+
+
+# Content-addressed script store: scripts zlib-compressed, keyed by hash, so
+# each distinct script is stored once however many stages (or, across
+# tenant databases sharing a backup, databases) use it
+def ensure_script_store(dbConn):
+    blob = {'postgresql': 'BYTEA', 'mysql': 'LONGBLOB'}.get(dbConn.db_type,
+                                                             'BLOB')
+    dbConn.execute('''
+      CREATE TABLE IF NOT EXISTS evolutions_scripts (
+          hash    VARCHAR(64) NOT NULL PRIMARY KEY,
+          script  ''' + blob + ''' NOT NULL )
+    ''')
+
+
+# Script with hash h from the store, or None if absent (just checking
+# presence if not decompress)
+def load_store_script(h, dbConn, decompress=True):
+    row = dbConn.execute('SELECT ' + ('script' if decompress else '1')
+                         + ' FROM evolutions_scripts WHERE hash = _?',
+                         [h]).fetchone()
+    if row is None or not decompress:
+        return row
+    return zlib.decompress(bytes(row[0])).decode('utf-8')
+
+
+# Adds script to the store, unless (concurrently) added already
+def store_script(h, script, dbConn):
+    stmt = {'postgresql': 'INSERT INTO evolutions_scripts (hash, script)'
+                          ' VALUES (_?, _?) ON CONFLICT DO NOTHING',
+            'mysql': 'INSERT IGNORE INTO evolutions_scripts (hash, script)'
+                     ' VALUES (_?, _?)'}.get(
+                dbConn.db_type, 'INSERT OR IGNORE INTO evolutions_scripts'
+                                ' (hash, script) VALUES (_?, _?)')
+    dbConn.execute(stmt, [h, zlib.compress(script.encode('utf-8'))])
+
+
+# Condition on evolutions rows with script text not yet in the store
+unstored_scripts_where = ' OR '.join(
+    "(%s_script IS NOT NULL AND %s_script NOT LIKE '%s%%')"
+    % (which, which, stored_ref_prefix) for which in ('apply', 'revert'))
+
+
+def has_unstored_scripts(dbConn):
+    return dbConn.execute('SELECT COUNT(*) FROM evolutions WHERE '
+                          + unstored_scripts_where).fetchone()[0] > 0
+
+
+# Moves scripts of existing evolutions rows into the store, a row at a time
+def migrate_to_store(dbConn):
+    ids = [ row[0] for row in dbConn.execute(
+        'SELECT id FROM evolutions WHERE ' + unstored_scripts_where
+        + ' ORDER BY id').fetchall() ]
+    for idx in ids:
+        for which in ('apply', 'revert'):
+            h, script = dbConn.execute(
+                'SELECT ' + which + '_hash, ' + which + '_script'
+                ' FROM evolutions WHERE id = _?', [idx]).fetchone()
+            if script is None or script.startswith(stored_ref_prefix):
+                continue
+            if load_store_script(h, dbConn, False) is None:
+                store_script(h, script, dbConn)
+            dbConn.execute('UPDATE evolutions SET ' + which + '_script = NULL'
+                           ' WHERE id = _?', [idx])
+    if ids:
+        logger.info('Moved scripts of %d stages to evolutions_scripts',
+                    len(ids))
+
+
+# Check if stages start with 1 and go in sequence, assuming sorted.  With
+# gaps (for selective runs, see selective_plan(), which may leave them if
+# they fail part way through), only that they increase.
+def check_stages(stages, src, gaps=False):
     if stages:
         indices = [ stage.idx for stage in stages ]
-        if indices[0] != 1 or indices[-1] != len(indices):
+        if gaps:
+            ok = indices[0] >= 1 and all(
+                a < b for a, b in zip(indices, indices[1:]))
+        else:
+            ok = indices[0] == 1 and indices[-1] == len(indices)
+        if not ok:
             raise Exception('Illegal stage sequence ' + str(indices)
                             + ' in ' + src)
     return stages
 
 
-# Invoke db command to execute script (DBAPI has no multistatement support)
+# Tokenizes SQL script text for given db type, yielding (kind, text) pairs
+# where kind is one of 'ws', 'comment', 'quoted' (strings, quoted identifiers
+# and dollar-quoted bodies), 'word', 'other' (single char, or the start or
+# end of a MySQL executable comment or optimizer hint, /*!...*/ or /*+...*/,
+# whose contents are SQL), 'end' (statement delimiter) or 'delimiter' (a
+# MySQL client DELIMITER command line).  Concatenating all texts except
+# 'delimiter' ones reproduces the script.
+_delimiter_re = re.compile(r'[ \t]*DELIMITER[ \t]+(\S+)[^\n]*\n?', re.I)
+_executable_re = re.compile(r'/\*[!+][0-9]*')
+_dollar_re = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)?\$')
+_word_re = re.compile(r'[A-Za-z0-9_]+[A-Za-z0-9_$]*')
+
+def sql_tokens(script, db_type):
+    mysql = db_type == 'mysql'
+    pg = db_type == 'postgresql'
+    quotes = '\'"`' if not pg else '\'"'
+    delim = ';'
+    n = len(script)
+    i = 0
+    line_start = True
+    executable = False # In MySQL executable comment
+    while i < n:
+        if line_start and mysql:
+            m = _delimiter_re.match(script, i)
+            if m:
+                delim = m.group(1)
+                yield ('delimiter', m.group(0))
+                i = m.end()
+                continue
+        line_start = False
+        c = script[i]
+        if c.isspace():
+            j = i + 1
+            while j < n and script[j].isspace():
+                j += 1
+            line_start = '\n' in script[i:j]
+            yield ('ws', script[i:j])
+        elif script.startswith(delim, i):
+            j = i + len(delim)
+            yield ('end', delim)
+        elif (script.startswith('--', i) and
+              (not mysql or i + 2 >= n or script[i+2].isspace())) or \
+             (c == '#' and mysql):
+            j = script.find('\n', i)
+            j = n if j < 0 else j
+            yield ('comment', script[i:j])
+        elif executable and script.startswith('*/', i):
+            j = i + 2
+            executable = False
+            yield ('other', '*/')
+        elif mysql and not executable and _executable_re.match(script, i):
+            j = _executable_re.match(script, i).end()
+            executable = True
+            yield ('other', script[i:j])
+        elif script.startswith('/*', i):
+            # Postgres block comments nest
+            depth = 1
+            j = i + 2
+            while j < n and depth:
+                if script.startswith('*/', j):
+                    depth -= 1
+                    j += 2
+                elif pg and script.startswith('/*', j):
+                    depth += 1
+                    j += 2
+                else:
+                    j += 1
+            yield ('comment', script[i:j])
+        elif c in quotes:
+            # Backslash escapes: MySQL strings, and Postgres E'' strings
+            esc = (mysql and c != '`') or \
+                  (pg and c == "'" and i > 0 and script[i-1] in 'eE' and
+                   (i < 2 or not (script[i-2].isalnum() or script[i-2] == '_')))
+            j = i + 1
+            while j < n:
+                if esc and script[j] == '\\':
+                    j += 2
+                elif script[j] == c:
+                    j += 1
+                    if j < n and script[j] == c:
+                        j += 1
+                    else:
+                        break
+                else:
+                    j += 1
+            yield ('quoted', script[i:j])
+        elif c == '$' and pg and (i == 0 or not (script[i-1].isalnum() or
+                                                 script[i-1] in '_$')) and \
+                _dollar_re.match(script, i):
+            tag = _dollar_re.match(script, i).group(0)
+            j = script.find(tag, i + len(tag))
+            j = n if j < 0 else j + len(tag)
+            yield ('quoted', script[i:j])
+        else:
+            m = _word_re.match(script, i)
+            j = m.end() if m else i + 1
+            if m and delim != ';':
+                # Delimiters such as '$$' may follow a word directly
+                k = script.find(delim, i + 1, j)
+                j = j if k < 0 else k
+            yield ('word' if m else 'other', script[i:j])
+        i = j
+
+
+# Splits script into individual statements, dropping delimiters and
+# comment-only/empty statements.  Sqlite trigger bodies contain ';', so a
+# statement there only ends once sqlite itself considers it complete.
+def split_sql(script, db_type):
+    if db_type == 'sqlite':
+        import sqlite3
+    stmts = []
+    buf = []
+    has_sql = False
+    for kind, text in sql_tokens(script, db_type):
+        if kind == 'end':
+            stmt = ''.join(buf).strip()
+            if (has_sql and db_type == 'sqlite' and
+                    not sqlite3.complete_statement(stmt + ';')):
+                buf.append(text)
+                continue
+            if has_sql:
+                stmts.append(stmt)
+            buf = []
+            has_sql = False
+        elif kind != 'delimiter':
+            buf.append(text)
+            has_sql = has_sql or kind not in ('ws', 'comment')
+    if has_sql:
+        stmts.append(''.join(buf).strip())
+    return stmts
+
+
+# Normalized script text, for hashing so cosmetic edits don't change hashes:
+# comments (other than evolutions: annotations, and MySQL executable
+# comments, which are tokenized as SQL) and whitespace outside quotes are
+# dropped, and keywords uppercased.  Other words are left alone,
+# identifiers being case sensitive in some databases.  Tokens are joined by
+# newlines, so those run together by dropping whitespace stay distinct.
+sql_keywords = frozenset('''
+    ADD ALL ALTER AND ANY AS ASC AUTOINCREMENT AUTO_INCREMENT BEGIN BETWEEN
+    BIGINT BLOB BOOLEAN BY CASCADE CASE CAST CHAR CHECK COLLATE COLUMN COMMIT
+    CONSTRAINT CREATE CROSS CURRENT_DATE CURRENT_TIMESTAMP DATE DATETIME
+    DECIMAL DEFAULT DELETE DESC DISTINCT DO DOUBLE DROP EACH ELSE END ENGINE
+    EXISTS FALSE FLOAT FOR FOREIGN FROM FULL FUNCTION GRANT GROUP HAVING IF
+    IN INDEX INNER INSERT INT INTEGER INTO IS JOIN KEY LANGUAGE LEFT LIKE
+    LIMIT NOT NULL NUMERIC OFFSET ON OR ORDER OUTER PRIMARY PROCEDURE REAL
+    REFERENCES RENAME REPLACE RESTRICT RETURN RETURNS REVOKE RIGHT ROLLBACK
+    ROW SCHEMA SELECT SEQUENCE SERIAL SET SMALLINT TABLE TEXT THEN TIME
+    TIMESTAMP TO TRANSACTION TRIGGER TRUE TRUNCATE UNION UNIQUE UPDATE USING
+    VALUES VARCHAR VIEW WHEN WHERE WITH'''.split())
+_annotation_re = re.compile(r'(--|#)\s*evolutions:')
+
+def normalize_sql(script, db_type):
+    parts = []
+    for kind, text in sql_tokens(script, db_type):
+        if kind == 'ws' or (kind == 'comment' and
+                            not _annotation_re.match(text)):
+            continue
+        if kind in ('comment', 'delimiter'):
+            text = ' '.join(text.split())
+        elif kind == 'word' and text.upper() in sql_keywords:
+            text = text.upper()
+        parts.append(text)
+    return '\n'.join(parts)
+
+
+# Hashes of normalized scripts are prefixed, to tell them from raw ones
+normalized_prefix = 'n:'
+
+def normalized_hash(script, db_type):
+    return normalized_prefix + hashlib.sha1(
+        normalize_sql(script, db_type).encode('utf-8')).hexdigest()
+
+
+# Switches stages (from dir) to normalized hashes, keeping the raw ones to
+# check files against when they are read again
+def normalize_stages(stages, db_type):
+    for stage in stages:
+        for which in ('apply', 'revert'):
+            h = normalized_hash(stage.read_script(which), db_type)
+            stage.file_hashes[which] = stage.hash(which)
+            setattr(stage, which + '_hash', h)
+
+
+# Objects (tables, views, indexes etc.) a script writes and reads, found
+# from the words of each statement, returned as (reads, writes) sets of
+# lowercased names without schemas, or None if the script has statements
+# whose effects can't be told this way (e.g. functions or procedural code).
+# Writes are the objects DDL statements create, change or drop, and the
+# targets of DML; anything else named counts as read, columns included.
+# Objects listed on `-- evolutions:touches` lines count as written, and make
+# a script count as known whatever its statements.
+_touches_re = re.compile(r'^[ \t]*(?:--|#)[ \t]*evolutions:touches[ \t]+(.*)$',
+                         re.M)
+_read_verbs = frozenset('''ANALYZE BEGIN COMMIT END EXPLAIN LOCK PRAGMA
+    RELEASE RESET ROLLBACK SAVEPOINT SELECT SET SHOW START VACUUM VALUES
+    WITH'''.split())
+_ddl_verbs = frozenset('''ALTER COMMENT CREATE DROP GRANT RENAME REVOKE
+    TRUNCATE'''.split())
+_dml_verbs = frozenset('DELETE INSERT MERGE REPLACE UPDATE'.split())
+_code_words = frozenset('EVENT FUNCTION PROCEDURE RULE TRIGGER'.split())
+_modifiers = frozenset('''CONCURRENTLY DELAYED EXISTS GLOBAL IF IGNORE LOCAL
+    LOW_PRIORITY MATERIALIZED NOT ONLY OR REPLACE TEMP TEMPORARY UNIQUE
+    UNLOGGED'''.split())
+
+def script_objects(script, db_type):
+    reads = set()
+    writes = set()
+    touches = _touches_re.findall(script)
+    for line in touches:
+        writes.update(object_name(name) for name in re.split(r'[,\s]+', line)
+                      if name)
+    for stmt in split_sql(script, db_type):
+        objects = statement_objects(stmt, db_type)
+        if objects is None:
+            if not touches:
+                return None
+        else:
+            reads |= objects[0]
+            writes |= objects[1]
+    return reads - writes, writes
+
+
+def object_name(name):
+    return name.split('.')[-1].strip('"`').lower()
+
+
+def statement_objects(stmt, db_type):
+    words = [] # (upper case word, or None if quoted; name, or None if keyword)
+    named = False
+    for kind, text in sql_tokens(stmt, db_type):
+        if kind in ('ws', 'comment'):
+            continue
+        name = None
+        if kind == 'word' and (text.upper() in sql_keywords or
+                               text.upper() in _modifiers):
+            words.append((text.upper(), None))
+        elif kind == 'word' and not text[0].isdigit():
+            name = object_name(text)
+            words.append((text.upper(), name))
+        elif kind == 'quoted' and text[0] in '"`':
+            name = object_name(text)
+            words.append((None, name))
+        elif kind == 'quoted' and text[0] == '$':
+            return None # Body of function or DO block
+        elif kind == 'other' and text == '.' and named:
+            words.pop() # Schema or table qualifier
+        named = name is not None
+    if not words:
+        return set(), set()
+    verb = words[0][0]
+    keywords = set( word for word, name in words if name is None )
+    if verb == 'WITH' and keywords & _dml_verbs:
+        return None
+    if verb in _ddl_verbs and verb != 'DROP' and keywords & _code_words:
+        return None
+    if verb not in _read_verbs | _ddl_verbs | _dml_verbs:
+        return None
+
+    # Names written: after the DDL verb, the objects it names, and targets
+    # of DML (before SET or WHERE for UPDATE and DELETE)
+    reads = set()
+    writes = set()
+    ddl = verb in _ddl_verbs
+    target = ddl or verb in ('INSERT', 'MERGE', 'REPLACE')
+    end = {'UPDATE': 'SET', 'DELETE': 'WHERE'}.get(verb)
+    prev = verb
+    for word, name in words[1:]:
+        if name is None:
+            if word == end:
+                end = None
+            if word == 'INTO' or (ddl and (
+                    word in ('INDEX', 'SEQUENCE', 'TABLE', 'VIEW') or
+                    (word == 'ON' and ('INDEX' in keywords or
+                                       verb in ('COMMENT', 'GRANT',
+                                                'REVOKE'))) or
+                    (word == 'TO' and 'RENAME' in (verb, prev)))):
+                target = True
+            elif word not in _modifiers:
+                target = False
+            prev = word
+            continue
+        if target or end is not None or verb in ('DROP', 'TRUNCATE'):
+            writes.add(name)
+        else:
+            reads.add(name)
+        target = False
+    return reads, writes
+
+
+# Runs script over DB-API statement by statement.  Stops at first failure;
+# Postgres notices fail the script too, since psql reports them on stderr.
+def execute_script_dbapi(idx, script_str, dbConn, conn=None, profile=True):
+    conn = conn or dbConn.get_script_conn()
+    notices = getattr(conn, 'notices', None)
+    profile = dbConn.profile if profile else None
+    db = conn.cursor()
+    try:
+        for n, stmt in enumerate(split_sql(script_str, dbConn.db_type), 1):
+            n_notices = len(notices) if notices is not None else 0
+            start = time.perf_counter()
+            try:
+                db.execute(stmt)
+                if db.description:
+                    db.fetchall()
+            except Exception as e:
+                error = str(e)
+            else:
+                error = None
+                if notices is not None and len(notices) > n_notices:
+                    error = ''.join(notices[n_notices:])
+            if profile is not None:
+                profile.add(dbConn.running or (idx, 'script'), n, stmt,
+                            time.perf_counter() - start,
+                            db.rowcount if db.rowcount >= 0 else None,
+                            lambda: explain(stmt, conn, dbConn.db_type))
+            if error is None:
+                continue
+            raise Exception('evolutions: script ' + str(idx) + "\n\t" +
+                            stmt.replace("\n", "\n\t") + "\n\t" +
+                            error.strip().replace("\n", "\n\t"))
+    finally:
+        db.close()
+
+
+# Execute script with engine chosen for connection, running its parallel
+# blocks (if any) concurrently
 def execute_script(idx, script_str, dbConn):
-    db_proc = subprocess.Popen(dbConn.cmd,
+    if parallel_marker not in script_str:
+        execute_script_session(idx, script_str, dbConn)
+        return
+    for is_parallel, part in parallel_parts(idx, script_str):
+        if is_parallel:
+            execute_parallel(idx, part, dbConn)
+        else:
+            execute_script_session(idx, part, dbConn)
+
+
+# Execute script in one session of engine chosen for connection (a given
+# DB-API connection, else the script connection, for 'dbapi')
+def execute_script_session(idx, script_str, dbConn, conn=None):
+    if dbConn.opts.engine == 'dbapi':
+        if dbConn.session_prefix:
+            execute_script_dbapi(idx, dbConn.session_prefix, dbConn, conn,
+                                 False)
+        execute_script_dbapi(idx, script_str, dbConn, conn)
+    else:
+        execute_script_client(idx, dbConn.session_prefix + script_str,
+                              dbConn)
+
+
+# EXPLAIN plan of (already run) DML statement, as text, or None if not DML
+def explain(stmt, conn, db_type):
+    first = next((text for kind, text in sql_tokens(stmt, db_type)
+                  if kind not in ('ws', 'comment')), '')
+    if first.upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE',
+                             'REPLACE', 'WITH'):
+        return None
+    db = conn.cursor()
+    try:
+        db.execute(('EXPLAIN QUERY PLAN ' if db_type == 'sqlite'
+                    else 'EXPLAIN ') + stmt)
+        return '\n'.join(' | '.join(map(str, row)) for row in db.fetchall())
+    except Exception as e:
+        return 'EXPLAIN failed: ' + str(e).strip()
+    finally:
+        db.close()
+
+
+# Parallel blocks: the statements between lines '-- evolutions:parallel' and
+# '-- evolutions:end-parallel' are independent of each other, and are run
+# concurrently, each in a session of its own, up to Options.parallel at once
+parallel_marker = 'evolutions:parallel'
+_parallel_re = re.compile(
+    r'^--[ \t]*evolutions:(parallel|end-parallel)[ \t]*\r?$', re.M)
+
+# Splits script into (is_parallel, text) parts, in order
+def parallel_parts(idx, script):
+    parts = []
+    pos = 0
+    in_block = False
+    for match in _parallel_re.finditer(script):
+        if (match.group(1) == 'parallel') == in_block:
+            raise Exception("Script %d: unexpected '%s' at offset %d"
+                            % (idx, match.group(0).strip(), match.start()))
+        parts.append((in_block, script[pos:match.start()]))
+        pos = match.end()
+        in_block = not in_block
+    if in_block:
+        raise Exception('Script %d: parallel block not ended' % (idx))
+    parts.append((False, script[pos:]))
+    return [ part for part in parts if part[1].strip() ]
+
+
+# Runs statements of a parallel block concurrently, waiting for all of them
+# and reporting all that failed.  Sqlite (a single writer) and connections
+# given by an application (with no way to open more) run them in turn.
+def execute_parallel(idx, block, dbConn):
+    stmts = split_sql(block, dbConn.db_type)
+    workers = min(dbConn.opts.parallel, len(stmts))
+    if dbConn.db_type == 'sqlite' or (dbConn.opts.engine == 'dbapi' and
+                                      dbConn.cmd is None and
+                                      dbConn.connect is None):
+        workers = 1
+    logger.info('Script %d: running %d statements, %d at a time', idx,
+                len(stmts), workers)
+
+    conns = queue.Queue()
+    if dbConn.opts.engine == 'dbapi':
+        conns.put(dbConn.get_script_conn())
+        for i in range(1, workers):
+            conns.put(dbConn.open_conn())
+
+    def run(stmt):
+        conn = conns.get() if dbConn.opts.engine == 'dbapi' else None
+        try:
+            if conn is None:
+                stmt = append_statements('', [stmt], dbConn.db_type)
+            execute_script_session(idx, stmt, dbConn, conn)
+            return None
+        except Exception as e:
+            return str(e)
+        finally:
+            if conn is not None:
+                conns.put(conn)
+
+    try:
+        if workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as pool:
+                errors = list(pool.map(run, stmts))
+        else:
+            errors = [ run(stmt) for stmt in stmts ]
+    finally:
+        while not conns.empty():
+            conn = conns.get()
+            if conn is not dbConn.script_conn:
+                conn.close()
+    errors = [ error for error in errors if error is not None ]
+    if errors:
+        raise Exception('Script %d: %d of %d parallel statements failed:\n'
+                        % (idx, len(errors), len(stmts)) + '\n'.join(errors))
+
+
+# Invoke db command to execute script (DBAPI has no multistatement support)
+def execute_script_client(idx, script_str, dbConn):
+    failed, output, error, _ = run_client(client_cmd(dbConn), dbConn,
+                                          text_chunks(script_str))
+    if failed:
+        raise script_error(str(idx), output, error)
+
+
+# Executes a stage's 'apply' or 'revert' script.  With the client engine,
+# scripts not already loaded are streamed from their files, unless known
+# to have parallel blocks (or not known not to).
+def execute_stage(stage, which, dbConn):
+    fname = stage.files.get(which)
+    if (dbConn.opts.engine != 'client' or fname is None
+            or which in stage.scripts or stage.parallel.get(which, True)):
+        execute_script(stage.idx, stage.read_script(which), dbConn)
+        return
+    h = hashlib.sha1()
+    failed, output, error, _ = run_client(
+        client_cmd(dbConn), dbConn, itertools.chain(
+            [dbConn.session_prefix.encode('utf-8')], file_chunks(fname, h)))
+    if failed:
+        raise script_error(str(stage.idx), output, error)
+    if h.hexdigest() != stage.file_hash(which):
+        raise Exception("File '%s' changed while running evolutions" % (fname))
+
+
+def script_error(which, output, error):
+    return Exception('evolutions: script ' + which + "\n\t" +
+                     output.replace("\n", "\n\t") + "\n\t" +
+                     error.replace("\n", "\n\t"))
+
+
+# Yields text encoded in chunks
+def text_chunks(text):
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i+chunk_size].encode('utf-8')
+
+
+# Yields file contents in chunks, updating hash h with them
+def file_chunks(fname, h):
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+            yield chunk
+
+
+# Bounded buffer keeping only the last limit bytes written to it
+class TailBuffer:
+    def __init__(self, limit=64 * 1024):
+        self.limit = limit
+        self.data = bytearray()
+        self.dropped = 0
+
+    def write(self, chunk):
+        self.data += chunk
+        if len(self.data) > self.limit:
+            excess = len(self.data) - self.limit
+            del self.data[0:excess]
+            self.dropped += excess
+
+    def text(self):
+        text = self.data.decode('utf-8', errors='replace')
+        if self.dropped:
+            text = '[... %d bytes not shown ...]\n' % (self.dropped) + text
+        return text
+
+
+# Reads stream into TailBuffer as data arrives, collecting all matches of
+# marker_re (if given) into markers
+def drain(stream, buf, marker_re=None, markers=None):
+    carry = b''
+    for chunk in iter(lambda: stream.read1(chunk_size), b''):
+        buf.write(chunk)
+        if marker_re is not None:
+            data = carry + chunk
+            markers.update(marker_re.findall(data))
+            carry = data[-64:]
+
+
+# Reads stream line by line into TailBuffer, leaving out lines matching
+# marker_re, whose number (counting from 0) gives how many scripts have
+# completed.  Records in state['first'] how many had when the first other
+# output arrived (lines longer than the buffer are flushed as output).
+def drain_marked(stream, buf, marker_re, state):
+    def line_out(line):
+        m = marker_re.search(line)
+        if m:
+            state['done'] = max(state['done'], int(m.group(1)) + 1)
+            return
+        buf.write(line)
+        if state['first'] is None:
+            state['first'] = state['done']
+    carry = b''
+    for chunk in iter(lambda: stream.read1(chunk_size), b''):
+        lines = (carry + chunk).split(b'\n')
+        carry = lines.pop()
+        for line in lines:
+            line_out(line + b'\n')
+        if len(carry) > buf.limit:
+            line_out(carry)
+            carry = b''
+    if carry:
+        line_out(carry)
+
+
+# Runs client command, feeding it chunks on stdin while its output is
+# drained into bounded buffers, so memory use does not grow with script or
+# output size.  Returns (failed, output tail, error tail, markers found).
+# With error_state, stderr lines matching error_marker_re are markers
+# handled by drain_marked rather than errors.
+def run_client(cmd, dbConn, chunks, marker_re=None, error_marker_re=None,
+               error_state=None):
+    db_proc = subprocess.Popen(cmd,
+                               env=dbConn.cmd_env,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
                                stdin=subprocess.PIPE)
-    output, error = db_proc.communicate(script_str.encode('utf-8'))
+    output = TailBuffer()
+    error = TailBuffer()
+    markers = set()
+    readers = [ threading.Thread(target=drain, args=(db_proc.stdout, output,
+                                                     marker_re, markers)),
+                threading.Thread(target=drain, args=(db_proc.stderr, error))
+                if error_state is None else
+                threading.Thread(target=drain_marked,
+                                 args=(db_proc.stderr, error,
+                                       error_marker_re, error_state)) ]
+    for reader in readers:
+        reader.start()
+    try:
+        try:
+            for chunk in chunks:
+                db_proc.stdin.write(chunk)
+            db_proc.stdin.close()
+        except BrokenPipeError:
+            pass # Client exited early, its output will say why
+    except BaseException:
+        db_proc.kill()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        db_proc.wait()
     # Note: Errors can happen with the return value from psql utility still being zero.
     # Therefore, explicitly look for errors in collected stderr content.
-    if (db_proc.returncode != 0) or (error):
-        raise Exception('evolutions: script ' + str(idx) + "\n\t" +
-                        output.decode('utf-8').replace("\n", "\n\t") + "\n\t" +
-                        error.decode('utf-8').replace("\n", "\n\t")
-        )
+    failed = (db_proc.returncode != 0) or bool(error.data) or bool(error.dropped)
+    return failed, output.text(), error.text(), markers
+
+
+# Appends stmts to script so they run after everything in the script,
+# whether or not the script ends in a delimiter, comment, or a changed
+# DELIMITER
+def append_statements(script, stmts, db_type):
+    delim = ';'
+    last = 'end'
+    for kind, text in sql_tokens(script, db_type):
+        if kind == 'delimiter':
+            delim = _delimiter_re.match(text).group(1)
+        elif kind not in ('ws', 'comment'):
+            last = kind
+    return (script + '\n' + ('' if last == 'end' else delim + '\n')
+            + ''.join(stmt + delim + '\n' for stmt in stmts))
+
+
+# SQL literal for text (or NULL for None) to pass to a client, spelling out
+# text needing escapes (which depend on server settings) or a client
+# encoding in hex
+_plain_text_re = re.compile(r'[ -\[\]-~\t\n\r]*')
+
+def sql_literal(text, db_type):
+    if text is None:
+        return 'NULL'
+    if _plain_text_re.fullmatch(text):
+        return "'" + text.replace("'", "''") + "'"
+    data = text.encode('utf-8').hex()
+    if db_type == 'mysql':
+        return "CONVERT(X'%s' USING utf8mb4)" % (data)
+    elif db_type == 'postgresql':
+        return "convert_from(decode('%s', 'hex'), 'UTF8')" % (data)
+    return "CAST(X'%s' AS TEXT)" % (data)
+
+
+# Client command stopping at the first error
+def batch_cmd(dbConn):
+    if dbConn.db_type == 'postgresql':
+        return dbConn.cmd[:-1] + ['-v', 'ON_ERROR_STOP=1'] + dbConn.cmd[-1:]
+    elif dbConn.db_type == 'sqlite':
+        return dbConn.cmd[0:1] + ['-bail'] + dbConn.cmd[1:]
+    return dbConn.cmd # mysql stops at errors when not interactive
+
+
+# Client command for a script's session: stopping at the first error if the
+# script may be retried, so no statements run after a lock timeout
+def client_cmd(dbConn):
+    return batch_cmd(dbConn) if dbConn.stop_on_error else dbConn.cmd
+
+
+# Marker written to stderr after each script in a Postgres batch, so that
+# notices and warnings (which do not stop psql) can be put down to the
+# script that wrote them (even if the script raised client_min_messages)
+_batch_warning = ("DO $evolutions$ DECLARE"
+                  " m TEXT := current_setting('client_min_messages'); BEGIN"
+                  " PERFORM set_config('client_min_messages', 'warning', true);"
+                  " RAISE WARNING 'evolutions:done:%d';"
+                  " PERFORM set_config('client_min_messages', m, true);"
+                  " END $evolutions$")
+_batch_warning_re = re.compile(rb'WARNING:  evolutions:done:([0-9]+)\s*$')
+
+
+# Runs scripts through a single client session, each followed by the
+# statement recording it (in records), after which the client prints a
+# marker.  Returns the number of scripts completed without error output, and
+# the client output and errors (else None) if it failed or wrote to stderr.
+def execute_batch_client(scripts, records, dbConn):
+    postgres = dbConn.db_type == 'postgresql'
+    def script_chunk(i, script):
+        script = append_statements(
+            script, [records[i], "SELECT 'evolutions:done:%d'" % (i)],
+            dbConn.db_type)
+        if postgres:
+            script += _batch_warning % (i) + ';\n'
+        return script.encode('utf-8')
+    chunks = (script_chunk(i, script) for i, script in enumerate(scripts))
+    error_state = { 'done': 0, 'first': None } if postgres else None
+    failed, output, error, markers = run_client(
+        batch_cmd(dbConn), dbConn, chunks,
+        re.compile(rb'evolutions:done:([0-9]+)'), _batch_warning_re, error_state)
+    done = 0
+    while str(done).encode() in markers:
+        done += 1
+    if error_state is not None and error_state['first'] is not None:
+        done = min(done, error_state['first'])
+    if failed:
+        return done, (output, error)
+    return done, None
+
+
+# Runs downs and ups, given as (is_ups, stage) pairs, through one client
+# session, which records each stage in the db straight after its script, so
+# the db matches what ran even if the client stops part way.  Fails naming
+# the first stage not completed or (on Postgres) that wrote to stderr, or if
+# all were, but with errors output.
+def run_batch(items, skip, dbConn):
+    scripts = []
+    prefixes = []
+    for is_ups, stage in items:
+        which = 'apply' if is_ups else 'revert'
+        if not is_ups:
+            logger.info('Running downs for stage %d', stage.idx)
+            scripts.append(stage.read_script('revert'))
+        elif stage.idx in skip:
+            logger.warning('Force skip running ups for stage %d', stage.idx)
+            scripts.append('')
+            which = None
+        else:
+            logger.info('Running ups for stage %d', stage.idx)
+            scripts.append(stage.read_script('apply'))
+        prefixes.append(which and session_prefix(
+            stage_timeouts(stage, which, dbConn), dbConn.db_type))
+    if not items:
+        return
+
+    # Settings last for the session, so once any are made all scripts make
+    # theirs (or restore defaults)
+    if any(prefixes):
+        defaults = ''.join(stmt + ';\n' for stmt in session_settings(
+            dbConn.db_type, None, None))
+        scripts = [ (prefix or defaults) + script if prefix is not None
+                    else script for prefix, script in zip(prefixes, scripts) ]
+
+    records = [ insert_sql(stage, dbConn) if is_ups else
+                'DELETE FROM evolutions WHERE id = %d' % (stage.idx)
+                for is_ups, stage in items ]
+    dbConn.conn.commit() # Client must not wait on rows changed by this session
+    with dbConn.metrics.phase('batch'):
+        done, failure = execute_batch_client(scripts, records, dbConn)
+    if failure is not None:
+        if done < len(items):
+            which = str(items[done][1].idx)
+        else:
+            which = 'batch %d-%d' % (items[0][1].idx, items[-1][1].idx)
+        raise script_error(which, *failure)
 
 
 # Executes given stage downs, and removes stage from db
 def run_and_remove_downs(stage, dbConn):
     logger.info('Running downs for stage %d', stage.idx)
-    execute_script(stage.idx, stage.revert_script, dbConn)
-    dbConn.execute('DELETE FROM evolutions WHERE id = _?', [stage.idx])
+    timed_execute_stage(stage, 'revert', dbConn)
+    delete_db(stage, dbConn)
 
 
 # Executes ups (unless in list to skip as already run) and record to db
 def run_and_add_ups(stage, skip, dbConn):
+    secs = None
     if stage.idx in skip:
         logger.warning('Force skip running ups for stage %d', stage.idx)
     else:
-        logger.info('Running ups for stage %d', stage.idx)
-        execute_script(stage.idx, stage.apply_script, dbConn)
+        spec = chunk_spec(stage, dbConn)
+        if spec is not None:
+            secs = run_chunked(stage, spec, dbConn)
+        else:
+            logger.info('Running ups for stage %d', stage.idx)
+            secs = timed_execute_stage(stage, 'apply', dbConn)
+    insert_db(stage, dbConn, secs)
+
+
+# Runs execute_stage(), with the stage's session settings and retries,
+# recording and returning the time it took
+def timed_execute_stage(stage, which, dbConn):
+    with stage_session(stage, which, dbConn) as settings:
+        start = time.perf_counter()
+        retry_lock_timeouts(stage, which, settings, dbConn,
+                            lambda: execute_stage(stage, which, dbConn))
+        secs = time.perf_counter() - start
+    dbConn.metrics.stages.append(
+        (stage.idx, 'ups' if which == 'apply' else 'downs', secs))
+    if dbConn.stage_hook is not None:
+        dbConn.stage_hook(stage, which)
+    return secs
+
+
+# Start of a stage's script, where annotations are looked for
+def script_head(stage, which):
+    fname = stage.files.get(which)
+    if which in stage.scripts or fname is None:
+        return stage.read_script(which)[0:4096]
+    with open(fname, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read(4096)
+
+
+# Chunked stages: ups scripts starting with a comment line like
+#   -- evolutions:chunked key=<table>.<column> rows=1000 sleep=0.5
+# are run once per range of the (integer) key column, with :batch_lo and
+# :batch_hi replaced by the range's bounds (lo inclusive, hi exclusive).
+# Progress is checkpointed, so a failed or killed run resumes where it
+# stopped; the stage is only recorded as applied after its last chunk.
+_chunked_re = re.compile(r'^--[ \t]*evolutions:chunked\b([^\n]*)$', re.M)
+_batch_param_re = re.compile(r':batch_(lo|hi)\b')
+_key_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_$.]*\.[A-Za-z_][A-Za-z0-9_$]*$')
+
+# Settings of chunked stage (dict with 'key', 'rows' and 'sleep'), or None
+# if stage is not chunked; only the start of the script is looked at
+def chunk_spec(stage, dbConn):
+    match = _chunked_re.search(script_head(stage, 'apply'))
+    if match is None:
+        return None
+    spec = {'rows': 1000, 'sleep': 0.0}
+    for param in match.group(1).split():
+        name, _, value = param.partition('=')
+        try:
+            if name == 'key' and _key_re.match(value):
+                spec['key'] = value
+            elif name == 'rows' and int(value) > 0:
+                spec['rows'] = int(value)
+            elif name == 'sleep' and float(value) >= 0:
+                spec['sleep'] = float(value)
+            else:
+                raise ValueError(param)
+        except ValueError:
+            raise Exception("Stage %d: bad chunked parameter '%s'"
+                            % (stage.idx, param))
+    if 'key' not in spec:
+        raise Exception('Stage %d: chunked stage needs key=<table>.<column>'
+                        % (stage.idx))
+    if dbConn.opts.chunk_rows is not None:
+        spec['rows'] = dbConn.opts.chunk_rows
+    if dbConn.opts.chunk_sleep is not None:
+        spec['sleep'] = dbConn.opts.chunk_sleep
+    return spec
+
+
+def ensure_checkpoints(dbConn):
+    dbConn.execute('''
+      CREATE TABLE IF NOT EXISTS evolutions_checkpoints (
+          id          INT NOT NULL PRIMARY KEY,
+          apply_hash  VARCHAR(64) NOT NULL,
+          next_lo     BIGINT NOT NULL,
+          batch_end   BIGINT NOT NULL,
+          updated_at  TIMESTAMP NOT NULL )
+    ''')
+
 
+# Runs ups of chunked stage from its checkpoint (if any), committing the
+# checkpoint after each chunk; returns seconds taken by chunks run
+def run_chunked(stage, spec, dbConn):
+    table, _, column = spec['key'].rpartition('.')
+    ensure_checkpoints(dbConn)
+    row = dbConn.execute('SELECT apply_hash, next_lo, batch_end'
+                         ' FROM evolutions_checkpoints WHERE id = _?',
+                         [stage.idx]).fetchone()
+    if row is not None and row[0] != stage.apply_hash:
+        logger.warning('Stage %d changed since checkpoint, restarting',
+                       stage.idx)
+        dbConn.execute('DELETE FROM evolutions_checkpoints WHERE id = _?',
+                       [stage.idx])
+        row = None
+    if row is not None:
+        lo, end = row[1], row[2]
+        logger.info('Resuming ups for stage %d from %s = %d', stage.idx,
+                    spec['key'], lo)
+    else:
+        lo, last = dbConn.execute('SELECT MIN(' + column + '), MAX(' + column
+                                  + ') FROM ' + table).fetchone()
+        if lo is None:
+            logger.info('Stage %d: no rows in %s, nothing to run', stage.idx,
+                        table)
+            return 0.0
+        if not isinstance(lo, int) or not isinstance(last, int):
+            raise Exception('Stage %d: chunk key %s is not an integer column'
+                            % (stage.idx, spec['key']))
+        end = last + 1
+        dbConn.execute('INSERT INTO evolutions_checkpoints (id, apply_hash,'
+                       ' next_lo, batch_end, updated_at) VALUES'
+                       ' (_?, _?, _?, _?, CURRENT_TIMESTAMP)',
+                       [stage.idx, stage.apply_hash, lo, end])
+        dbConn.conn.commit()
+        logger.info('Running ups for stage %d in chunks of %d rows'
+                    ' (%s = %d to %d)', stage.idx, spec['rows'], spec['key'],
+                    lo, last)
+
+    script = stage.read_script('apply')
+    secs = 0.0
+    with stage_session(stage, 'apply', dbConn) as settings:
+        while lo < end:
+            row = dbConn.execute('SELECT ' + column + ' FROM ' + table
+                                 + ' WHERE ' + column + ' >= _? ORDER BY '
+                                 + column + ' LIMIT 1 OFFSET _?',
+                                 [lo, spec['rows']]).fetchone()
+            hi = end if row is None else min(row[0], end)
+            chunk = _batch_param_re.sub(
+                lambda m: str(lo if m.group(1) == 'lo' else hi), script)
+            start = time.perf_counter()
+            retry_lock_timeouts(stage, 'apply', settings, dbConn,
+                                lambda: execute_script(stage.idx, chunk, dbConn))
+            secs += time.perf_counter() - start
+            dbConn.execute('UPDATE evolutions_checkpoints SET next_lo = _?,'
+                           ' updated_at = CURRENT_TIMESTAMP WHERE id = _?',
+                           [hi, stage.idx])
+            dbConn.conn.commit()
+            logger.debug('Stage %d: done %s < %d', stage.idx, spec['key'], hi)
+            lo = hi
+            if lo < end and spec['sleep'] > 0:
+                time.sleep(spec['sleep'])
+    dbConn.execute('DELETE FROM evolutions_checkpoints WHERE id = _?',
+                   [stage.idx])
+    dbConn.metrics.stages.append((stage.idx, 'ups', secs))
+    if dbConn.stage_hook is not None:
+        dbConn.stage_hook(stage, 'apply')
+    return secs
+
+
+# Timeouts for the sessions running a script, so that DDL waiting behind
+# application transactions gives up instead of holding up everything queued
+# behind it.  Set for the run by options, or for a script by a line like
+#   -- evolutions:timeouts lock=2000 statement=600000 retries=5
+# (in milliseconds).  Scripts failing on a lock timeout are run again, after
+# a growing, randomized delay, up to the number of retries.
+_timeouts_re = re.compile(r'^--[ \t]*evolutions:timeouts\b([^\n]*)$', re.M)
+_lock_timeout_re = re.compile(r'lock timeout|lock wait timeout exceeded'
+                              r'|database is locked', re.I)
+
+# Timeout settings (dict with 'lock' and 'statement', None where not set,
+# and 'retries') of a stage's 'apply' or 'revert' script
+def stage_timeouts(stage, which, dbConn):
+    settings = {'lock': dbConn.opts.stage_lock_timeout,
+                'statement': dbConn.opts.stage_statement_timeout,
+                'retries': None}
+    match = _timeouts_re.search(script_head(stage, which))
+    for param in (match.group(1).split() if match else []):
+        name, _, value = param.partition('=')
+        if name in settings and value.isdigit():
+            settings[name] = int(value)
+        else:
+            raise Exception("Stage %d: bad timeouts parameter '%s'"
+                            % (stage.idx, param))
+    if settings['retries'] is None:
+        settings['retries'] = (dbConn.opts.lock_retries if settings['lock']
+                               else 0)
+    return settings
+
+
+# Statements applying timeouts (in milliseconds, None for the default) to
+# a session
+def session_settings(db_type, lock_ms, statement_ms):
+    def value(ms, scale=1):
+        if ms is None:
+            return 'DEFAULT'
+        return str(ms if scale == 1 else max(1, math.ceil(ms / scale)))
+    if db_type == 'postgresql':
+        return ['SET lock_timeout = ' + value(lock_ms),
+                'SET statement_timeout = ' + value(statement_ms)]
+    elif db_type == 'mysql':
+        return ['SET SESSION lock_wait_timeout = ' + value(lock_ms, 1000),
+                'SET SESSION innodb_lock_wait_timeout = '
+                + value(lock_ms, 1000),
+                'SET SESSION max_execution_time = ' + value(statement_ms)]
+    # Sqlite has no statement timeout; 5s is Python's default busy timeout
+    return ['PRAGMA busy_timeout = %d' % (5000 if lock_ms is None
+                                          else lock_ms)]
+
+
+# Text to run at the start of sessions for script with given settings
+def session_prefix(settings, db_type):
+    if settings['lock'] is None and settings['statement'] is None:
+        return ''
+    return ''.join(stmt + ';\n' for stmt in session_settings(
+        db_type, settings['lock'], settings['statement']))
+
+
+# Puts a stage's session settings in effect for scripts run in the block,
+# giving the settings; the 'dbapi' engine's session is reset afterwards.
+# Client sessions of scripts that may be retried stop at the first error.
+@contextlib.contextmanager
+def stage_session(stage, which, dbConn):
+    settings = stage_timeouts(stage, which, dbConn)
+    dbConn.session_prefix = session_prefix(settings, dbConn.db_type)
+    dbConn.running = (stage.idx, 'ups' if which == 'apply' else 'downs')
+    dbConn.stop_on_error = settings['retries'] > 0
+    try:
+        yield settings
+    finally:
+        reset = dbConn.session_prefix and dbConn.opts.engine == 'dbapi'
+        dbConn.session_prefix = ''
+        dbConn.running = None
+        dbConn.stop_on_error = False
+        if reset:
+            execute_script_dbapi(stage.idx, ';\n'.join(session_settings(
+                dbConn.db_type, None, None)), dbConn, None, False)
+
+
+# Calls run (executing a stage's script), calling it again after failures
+# due to lock timeouts while retries are left
+def retry_lock_timeouts(stage, which, settings, dbConn, run):
+    attempt = 0
+    while True:
+        try:
+            return run()
+        except Exception as e:
+            if attempt >= settings['retries'] or not _lock_timeout_re.search(
+                    str(e)):
+                raise
+            attempt += 1
+            delay = min(60.0, dbConn.opts.retry_backoff * 2 ** (attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+            logger.warning('Stage %d %s failed on lock timeout, retry %d of %d'
+                           ' in %.1fs', stage.idx,
+                           'ups' if which == 'apply' else 'downs', attempt,
+                           settings['retries'], delay)
+            time.sleep(delay)
+
+
+# Removes an evolution row
+def delete_db(stage, dbConn):
+    dbConn.execute('DELETE FROM evolutions WHERE id = _?', [stage.idx])
+
+
+# Inserts an evolution row, with seconds the ups took (if run and timed)
+def insert_db(stage, dbConn, secs=None):
     dbConn.execute('''
         INSERT INTO evolutions (id, applied_at, apply_hash, revert_hash,
-                                apply_script, revert_script) VALUES
-                                (_?, CURRENT_TIMESTAMP, _?, _?, _?, _?)
+                                apply_script, revert_script, apply_ms) VALUES
+                                (_?, CURRENT_TIMESTAMP, _?, _?, _?, _?, _?)
     ''', [stage.idx, stage.apply_hash, stage.revert_hash,
-          stage.apply_script, stage.revert_script])
+          stored_script(stage, 'apply', dbConn),
+          stored_script(stage, 'revert', dbConn),
+          None if secs is None else int(secs * 1000)])
+
+
+# Statement inserting an evolution row, for a client to run
+def insert_sql(stage, dbConn):
+    values = [ sql_literal(text, dbConn.db_type) for text in (
+        stage.apply_hash, stage.revert_hash,
+        stored_script(stage, 'apply', dbConn),
+        stored_script(stage, 'revert', dbConn)) ]
+    return ('INSERT INTO evolutions (id, applied_at, apply_hash, revert_hash,'
+            ' apply_script, revert_script) VALUES (%d, CURRENT_TIMESTAMP, %s)'
+            % (stage.idx, ', '.join(values)))
 
 
 # Updates an evolution row
 def update_db(stage, dbConn):
     dbConn.execute('''
         UPDATE evolutions SET apply_hash = _?, revert_hash = _?,
-                              apply_script = _?, revert_script = _?
+                              apply_script = _?, revert_script = _?,
+                              apply_ms = NULL
                           WHERE id = _?
     ''', [stage.apply_hash, stage.revert_hash,
-          stage.apply_script, stage.revert_script, stage.idx])
+          stored_script(stage, 'apply', dbConn),
+          stored_script(stage, 'revert', dbConn), stage.idx])
 
 
 # Inserts or updates stages we were told to skip, return updated DB stages
@@ -260,105 +1851,1210 @@ def update_for_skips(dir_stages, db_stages, skip, dbConn):
     return db_stages
 
 
-# 1. Go forward through DB rows to find first difference from files
-# 2. Run downs from above down to and including that row, removing DB rows
-# 3. Run files and insert DB rows starting from there
-# 4. Return resulting updated DB stage objects
-def evolve(dir_stages, db_stages, skip, prod_mode, dbConn):
-    dir_len = len(dir_stages)
-    db_len = len(db_stages)
+# Stage to run downs of a DB stage from: the dir stage if it has the same
+# downs script (so it can be streamed from file), else the DB stage itself
+def revert_stage(db_stage, dir_stages):
+    i = db_stage.idx - 1
+    if i < len(dir_stages) and dir_stages[i].revert_hash == db_stage.revert_hash:
+        return dir_stages[i]
+    return db_stage
 
-    # Finds first differing stage, executes downs from DB up to that one,
+
+# Index of first stage in dir differing from DB, i.e. first needing running
+def first_difference(dir_stages, db_stages):
     s = 0
-    while s < min(dir_len, db_len):
-        if dir_stages[s].apply_hash != db_stages[s].apply_hash:
+    while s < min(len(dir_stages), len(db_stages)):
+        if (dir_stages[s].apply_hash != db_stages[s].apply_hash or
+                db_stages[s].idx != s + 1):
             break
         s += 1
-
-    # s is now index of first file that needs to be run
-    # Run all DB downs in reverse through here
-    downs_r = range(db_len-1, s-1, -1)
-    if prod_mode and downs_r:
-        raise Exception('In production mode but downs ' + str(downs_r)
+    return s
+
+
+# Plan of evolving: indices of stages to run downs of (in that order) and
+# of those to run ups of.  All stages from s (see first_difference()) on are
+# rerun, unless selective, when only those selective_plan() finds are.
+def plan_evolutions(dir_stages, db_stages, s, dbConn):
+    if dbConn.opts.selective and s < len(db_stages):
+        return selective_plan(dir_stages, db_stages, s, dbConn)
+    return ([ stage.idx for stage in reversed(db_stages[s:]) ],
+            [ stage.idx for stage in dir_stages[s:] ])
+
+
+# Plan rerunning only stages from s on that changed, or depend on ones rerun
+# before them: that write objects those touch, or touch objects those write
+# (see script_objects()).  Once a stage whose objects are not known is
+# rerun, all later ones are too.  Stages in the evolutions table but not the
+# dir, or the other way round, count as changed.  Downs are run latest
+# first, then ups earliest first, skipping the stages not rerun, which touch
+# nothing that those rerun before them do.
+def selective_plan(dir_stages, db_stages, s, dbConn):
+    by_idx = dict((stage.idx, stage) for stage in db_stages)
+    reads = set()
+    writes = set()
+    known = True
+    downs = []
+    ups = []
+    for idx in range(s + 1, max(len(dir_stages), db_stages[-1].idx) + 1):
+        dir_stage = dir_stages[idx - 1] if idx <= len(dir_stages) else None
+        db_stage = by_idx.get(idx)
+        if db_stage is None and idx <= db_stages[-1].idx:
+            logger.warning('Stage %d missing from evolutions table', idx)
+        changed = (dir_stage is None or db_stage is None or
+                   dir_stage.apply_hash != db_stage.apply_hash)
+        if known:
+            objects = stage_objects([ stage for stage in (db_stage, dir_stage)
+                                      if stage is not None ], dbConn)
+            if not changed and objects is not None and \
+                    not (objects[1] & (reads | writes)) and \
+                    not (objects[0] & writes):
+                continue
+            if objects is None:
+                known = False
+            else:
+                reads |= objects[0]
+                writes |= objects[1]
+        if db_stage is not None:
+            downs.append(idx)
+        if dir_stage is not None:
+            ups.append(idx)
+    downs.reverse()
+    logger.info('Selective plan: rerunning %d of %d stages from stage %d',
+                len(ups), len(dir_stages) - s, s + 1)
+    return downs, ups
+
+
+# Objects written and read (as script_objects()) by all the scripts of the
+# given versions of a stage, or None if not known for any
+def stage_objects(stages, dbConn):
+    reads = set()
+    writes = set()
+    seen = set()
+    for stage in stages:
+        for which in ('apply', 'revert'):
+            h = stage.hash(which)
+            if h in seen:
+                continue
+            seen.add(h)
+            try:
+                script = stage.read_script(which)
+            except Exception as e:
+                logger.debug('Stage %d: %s', stage.idx, e)
+                return None # Not stored
+            objects = script_objects(script, dbConn.db_type)
+            if objects is None:
+                logger.info('Stage %d %s script: objects not known',
+                            stage.idx, which)
+                return None
+            reads |= objects[0]
+            writes |= objects[1]
+    return reads, writes
+
+
+# Rewrites hashes of DB stages hashed the other way (raw or normalized) from
+# the dir stages, where the scripts match, so switching hashing mode doesn't
+# rerun stages.  Raw hashes in the DB are of the scripts as they were, so
+# the scripts stored there are normalized to compare.  Stops at the first
+# stage whose ups differ, all from there being rerun anyway.  Only updates
+# the stages in memory, not the evolutions table, unless update.
+def convert_hashes(dir_stages, db_stages, dbConn, update=True):
+    for dir_stage, db_stage in zip(dir_stages, db_stages):
+        if db_stage.idx != dir_stage.idx:
+            break
+        hashes = {}
+        for which in ('apply', 'revert'):
+            old = db_stage.hash(which)
+            new = dir_stage.hash(which)
+            if old == new or (old.startswith(normalized_prefix) ==
+                              new.startswith(normalized_prefix)):
+                continue
+            if old.startswith(normalized_prefix):
+                match = old == normalized_hash(dir_stage.read_script(which),
+                                               dbConn.db_type)
+            elif dir_stage.file_hashes.get(which) == old:
+                match = True
+            else:
+                try:
+                    script = db_stage.read_script(which)
+                except Exception as e:
+                    logger.debug('Stage %d: %s', db_stage.idx, e)
+                    continue # Not stored, so rerun
+                match = new == normalized_hash(script, dbConn.db_type)
+            if match:
+                hashes[which] = new
+        if db_stage.apply_hash != dir_stage.apply_hash and \
+                'apply' not in hashes:
+            break
+        if not hashes:
+            continue
+        logger.info('Converting hashes of stage %d', db_stage.idx)
+        if update:
+            rehash_db(db_stage, hashes, dbConn)
+        for which, h in hashes.items():
+            setattr(db_stage, which + '_hash', h)
+
+
+# Updates hashes of an evolution row, copying its scripts in the script
+# store (if there) to the new hashes
+def rehash_db(db_stage, hashes, dbConn):
+    row = dbConn.execute('SELECT apply_script IS NULL, revert_script IS NULL'
+                         ' FROM evolutions WHERE id = _?',
+                         [db_stage.idx]).fetchone()
+    for which, h in hashes.items():
+        if row[0 if which == 'apply' else 1]:
+            script = load_store_script(db_stage.hash(which), dbConn)
+            if script is not None:
+                store_script(h, script, dbConn)
+    dbConn.execute('UPDATE evolutions SET apply_hash = _?, revert_hash = _?'
+                   ' WHERE id = _?',
+                   [hashes.get('apply', db_stage.apply_hash),
+                    hashes.get('revert', db_stage.revert_hash),
+                    db_stage.idx])
+
+
+# 1. Go forward through DB rows to find first difference from files, and
+#    plan from there (unless plan, as from plan_evolutions(), is given)
+# 2. Run downs from above down to and including that row, removing DB rows
+# 3. Run files and insert DB rows starting from there
+# 4. Return resulting updated DB stage objects
+def evolve(dir_stages, db_stages, skip, prod_mode, dbConn, plan=None):
+    if plan is None:
+        plan = plan_evolutions(dir_stages, db_stages,
+                               first_difference(dir_stages, db_stages), dbConn)
+    downs, ups = plan
+    if prod_mode and downs:
+        raise Exception('In production mode but downs ' + str(downs)
                         +' needs running; aborting!')
-    for i in downs_r:
-        run_and_remove_downs(db_stages[i], dbConn)
-    db_stages = db_stages[0:s]
+    by_idx = dict((stage.idx, stage) for stage in db_stages)
+    down_stages = [ revert_stage(by_idx[idx], dir_stages) for idx in downs ]
+    check_db_downs([ stage for stage in down_stages
+                     if stage is by_idx[stage.idx] ], dbConn)
+    up_stages = [ dir_stages[idx - 1] for idx in ups ]
+    reverted = set(downs)
+    kept = [ stage for stage in db_stages if stage.idx not in reverted ]
+
+    # Batched: all downs and ups through one client session (unless there
+    # are chunked stages, run chunk by chunk)
+    if (dbConn.opts.batch and dbConn.opts.engine == 'client' and
+            not any(chunk_spec(stage, dbConn) for stage in up_stages
+                    if stage.idx not in skip)):
+        run_batch([ (False, stage) for stage in down_stages ] +
+                  [ (True, stage) for stage in up_stages ], skip, dbConn)
+    else:
+        for stage in down_stages:
+            run_and_remove_downs(stage, dbConn)
 
-    # Now run the ups
-    for i in range(s, dir_len):
-        run_and_add_ups(dir_stages[i], skip, dbConn)
+        # Now run the ups
+        for stage in up_stages:
+            run_and_add_ups(stage, skip, dbConn)
 
-    return db_stages[0:s] + dir_stages[s:]
+    return sorted(kept + up_stages, key=lambda stage: stage.idx)
 
 
 def usage(invoked_name):
-    print("usage: " + path.basename(invoked_name)
-          + " <db_url> <db_user> <db_pass> <evolutions_dir> [--skip=<stages>] [--prod]\n"
-          + "   --skip=<stages> = comma-separated indices to assume already run\n"
-          + "   --prod          = abort if downs need to be run (for production)")
+    name = path.basename(invoked_name)
+    print("usage: " + name
+          + " <db_url> <db_user> <db_pass> <evolutions_dir> [options]\n"
+          + "       " + name + " --fleet=<targets_file> <evolutions_dir> [options]\n"
+          + "       " + name + " --bundle=<bundle_file> <evolutions_dir>\n"
+          + "options:\n"
+          + "   --skip=<stages>   = comma-separated indices to assume already run\n"
+          + "   --prod            = abort if downs need to be run (for production)\n"
+          + "   --engine=<name>   = run scripts via command line 'client' (default)\n"
+          + "                       or in-process over DB-API ('dbapi')\n"
+          + "   --manifest=<file> = cache of file hashes, to skip rehashing\n"
+          + "   --batch           = run all downs and ups in one client session\n"
+          + "   --store-limit=<n> = store scripts over n bytes (16MiB) in the\n"
+          + "                       evolutions table by hash only\n"
+          + "   --lock-wait=<s>   = seconds to wait for another run (300)\n"
+          + "   --metrics-json=<file> = write timings as JSON\n"
+          + "   --metrics-prom=<file> = write timings as Prometheus textfile\n"
+          + "   --snapshot-cache=<dir> = restore/save database snapshots\n"
+          + "   --script-store    = keep scripts compressed and deduplicated\n"
+          + "                       in evolutions_scripts table\n"
+          + "   --normalized-hashes = hash scripts ignoring comments,\n"
+          + "                       whitespace and keyword case\n"
+          + "   --selective       = rerun only stages after a changed one\n"
+          + "                       that touch the same tables\n"
+          + "   --chunk-rows=<n>  = rows per chunk of chunked stages\n"
+          + "   --chunk-sleep=<s> = seconds to pause between chunks\n"
+          + "   --parallel=<n>    = sessions running parallel blocks (4)\n"
+          + "   --stage-lock-timeout=<ms> = lock timeout for scripts\n"
+          + "   --stage-statement-timeout=<ms> = statement timeout for scripts\n"
+          + "   --lock-retries=<n> = retries of scripts failing on lock\n"
+          + "                       timeout (3)\n"
+          + "   --retry-backoff=<s> = seconds before first retry, doubled\n"
+          + "                       for each further one (1)\n"
+          + "   --profile=<file>  = write slowest statements of each script\n"
+          + "                       as JSON (scripts run in-process)\n"
+          + "   --profile-top=<n> = statements listed per script (10)\n"
+          + "   --profile-explain=<ms> = include EXPLAIN of DML statements\n"
+          + "                       taking longer\n"
+          + "   --watch           = keep running, evolving again when files\n"
+          + "                       change (for development)\n"
+          + "   --watch-interval=<s> = seconds between checks for changes (1)\n"
+          + "   --rehearse        = run on a copy of the database instead,\n"
+          + "                       reporting timings, and drop the copy\n"
+          + "   --report=<file>   = write results (per target, or of\n"
+          + "                       rehearsal) as JSON\n"
+          + "fleet options:\n"
+          + "   --jobs=<n>        = number of targets to evolve concurrently (4)")
     return 1
 
 
-def do_evolutions(ev_dir, skip, prod_mode, dbConn):
+# Options given on command line, after positional arguments
+class Options:
+    def __init__(self):
+        self.skip = set()
+        self.prod_mode = False
+        self.engine = 'client'
+        self.manifest = None
+        self.batch = False     # Run all scripts in one client session
+        self.store_limit = 16 << 20 # Larger scripts stored by reference
+        self.lock_wait = 300   # Seconds to wait for lock on evolutions
+        self.metrics_json = None
+        self.metrics_prom = None
+        self.snapshot_cache = None # Dir of database dumps by hash chain
+        self.script_store = False # Store scripts in evolutions_scripts
+        self.normalized_hashes = False # Hash scripts' normalized text
+        self.selective = False # Rerun only stages depending on changed ones
+        self.chunk_rows = None # Rows per chunk of chunked stages, None for
+        self.chunk_sleep = None # script's own (or default) setting
+        self.parallel = 4      # Sessions running parallel blocks
+        self.stage_lock_timeout = None # Milliseconds, for scripts' sessions
+        self.stage_statement_timeout = None
+        self.lock_retries = 3  # Retries of scripts failing on lock timeout
+        self.retry_backoff = 1.0 # Seconds before first retry, then doubled
+        self.profile = None
+        self.profile_top = 10
+        self.profile_explain = None
+        self.watch = False
+        self.watch_interval = 1.0
+        self.rehearse = False
+        self.jobs = 4
+        self.report = None
+
+
+# Parses options into Options object, or returns None if any not valid
+def parse_options(args):
+    opts = Options()
+    for arg in args:
+        name, _, value = arg.partition('=')
+        if name == '--skip' and value:
+            opts.skip = set(map(int, value.split(',')))
+            logger.info('Force skip: %s', (','.join(map(str, opts.skip))))
+        elif arg == '--prod':
+            opts.prod_mode = True
+        elif name == '--engine' and value in ('client', 'dbapi'):
+            opts.engine = value
+        elif name == '--manifest' and value:
+            opts.manifest = value
+        elif arg == '--batch':
+            opts.batch = True
+        elif name == '--store-limit' and value.isdigit():
+            opts.store_limit = int(value)
+        elif name == '--lock-wait' and value.isdigit():
+            opts.lock_wait = int(value)
+        elif name == '--metrics-json' and value:
+            opts.metrics_json = value
+        elif name == '--metrics-prom' and value:
+            opts.metrics_prom = value
+        elif name == '--snapshot-cache' and value:
+            opts.snapshot_cache = value
+        elif arg == '--script-store':
+            opts.script_store = True
+        elif arg == '--normalized-hashes':
+            opts.normalized_hashes = True
+        elif arg == '--selective':
+            opts.selective = True
+        elif name == '--chunk-rows' and value.isdigit() and int(value) > 0:
+            opts.chunk_rows = int(value)
+        elif name == '--chunk-sleep' and re.match(r'^[0-9]+(\.[0-9]*)?$',
+                                                  value):
+            opts.chunk_sleep = float(value)
+        elif name == '--parallel' and value.isdigit() and int(value) > 0:
+            opts.parallel = int(value)
+        elif name == '--stage-lock-timeout' and value.isdigit():
+            opts.stage_lock_timeout = int(value)
+        elif name == '--stage-statement-timeout' and value.isdigit():
+            opts.stage_statement_timeout = int(value)
+        elif name == '--lock-retries' and value.isdigit():
+            opts.lock_retries = int(value)
+        elif name == '--retry-backoff' and re.match(r'^[0-9]+(\.[0-9]*)?$',
+                                                    value):
+            opts.retry_backoff = float(value)
+        elif name == '--profile' and value:
+            opts.profile = value
+        elif name == '--profile-top' and value.isdigit() and int(value) > 0:
+            opts.profile_top = int(value)
+        elif name == '--profile-explain' and value.isdigit():
+            opts.profile_explain = int(value)
+        elif arg == '--watch':
+            opts.watch = True
+        elif name == '--watch-interval' and re.match(r'^[0-9]+(\.[0-9]*)?$',
+                                                     value):
+            opts.watch_interval = float(value)
+        elif arg == '--rehearse':
+            opts.rehearse = True
+        elif name == '--jobs' and value.isdigit() and int(value) > 0:
+            opts.jobs = int(value)
+        elif name == '--report' and value:
+            opts.report = value
+        else:
+            return None
+    return opts
+
+
+# Outcome of an evolutions run, filled in by do_evolutions()
+class EvolutionsResult:
+    def __init__(self):
+        self.stages = 0     # Number of stages in database afterwards
+        self.downs = []     # Indices of stages reverted, in order run
+        self.ups = []       # Indices of stages applied (or skipped), in order
+        self.skipped = []   # Indices of ups assumed already run
+        self.plan = None    # Key of DB state planned from (hash of chain)
+        self.metrics = None # Metrics of the run
+        self.profile = None # Profile of statements run, if profiling
+
+    @property
+    def up_to_date(self):
+        return not self.downs and not self.ups
+
+    def as_dict(self):
+        return {'stages': self.stages, 'downs': self.downs, 'ups': self.ups,
+                'skipped': self.skipped, 'plan': self.plan}
+
+
+# Runs evolutions, committing changes.  May be given dir_stages already
+# scanned, and a dict plans caching plan_evolutions() results keyed by DB
+# apply hash chain (and downs hashes, if selective), for use across
+# databases.  If result (an EvolutionsResult) is given, the stages run are
+# recorded in it.  May also be given db_stages as returned by an earlier
+# run, to check against before scanning the database (which is only done
+# once it needs evolving).
+def do_evolutions(ev_dir, skip, prod_mode, dbConn, manifest=None,
+                  dir_stages=None, plans=None, result=None, db_stages=None):
+
+    metrics = dbConn.metrics
 
     # 1. Scan dir files in order, compute hashes (hashlib.sha1().hexdigest())
-    dir_stages = check_stages(scan_dir_stages(ev_dir), ev_dir)
+    if dir_stages is None:
+        with metrics.phase('scan_dir'):
+            dir_stages = scan_dir(ev_dir, manifest,
+                                  hash_dialect(dbConn.db_type, dbConn.opts))
+
+    # 2. Scan DB files, done if up to date (without needing lock)
+    if db_stages is None:
+        with metrics.phase('scan_db'):
+            db_stages = check_stages(scan_db_stages(dbConn), 'db',
+                                     dbConn.opts.selective)
+        logger.info("Got %d stages from DB '%s'", len(db_stages),
+                    dbConn.db_name)
+        logger.debug('\n\t%s', '\n'.join(map(str, db_stages)))
+    if (not skip and len(db_stages) == len(dir_stages) and
+            first_difference(dir_stages, db_stages) == len(dir_stages) and
+            not (dbConn.opts.script_store and has_unstored_scripts(dbConn))):
+        logger.info('Database is up to date.')
+        if result is not None:
+            result.stages = len(db_stages)
+        return db_stages
+
+    # 3. Lock, and rescan since another run may have evolved while waiting
+    with metrics.phase('lock_wait'):
+        acquire_lock(dbConn)
+    try:
+        with metrics.phase('scan_db'):
+            db_stages = check_stages(scan_db_stages(dbConn), 'db',
+                                     dbConn.opts.selective)
+
+        # 4. Move scripts to store if requested, convert hashes made in the
+        #    other hashing mode, and handle skips
+        if dbConn.opts.script_store:
+            ensure_script_store(dbConn)
+            migrate_to_store(dbConn)
+        convert_hashes(dir_stages, db_stages, dbConn)
+        db_stages = update_for_skips(dir_stages, db_stages, skip, dbConn)
+
+        # 5. Restore cached snapshot into empty database (snapshots are
+        #    keyed by stages alone, so are only for databases built from them)
+        fresh = (dbConn.opts.snapshot_cache and not db_stages and not skip
+                 and not other_tables(dbConn))
+        if fresh:
+            with metrics.phase('snapshot_restore'):
+                db_stages = restore_from_cache(dir_stages, dbConn)
+
+        # 6. Evolve
+        chain = tuple(stage.apply_hash for stage in db_stages)
+        key = (chain, tuple(stage.idx for stage in db_stages))
+        if dbConn.opts.selective:
+            # Selective plans also depend on the downs scripts in the DB
+            key += (tuple(stage.revert_hash for stage in db_stages),)
+        if plans is None:
+            plans = {}
+        if key not in plans:
+            plans[key] = plan_evolutions(
+                dir_stages, db_stages, first_difference(dir_stages, db_stages),
+                dbConn)
+        plan = plans[key]
+        if result is not None:
+            result.downs, result.ups = list(plan[0]), list(plan[1])
+            result.skipped = [ idx for idx in result.ups if idx in skip ]
+            result.plan = hashlib.sha1(''.join(chain).encode()).hexdigest()
+        with metrics.phase('evolve'):
+            db_stages = evolve(dir_stages, db_stages, skip, prod_mode,
+                               dbConn, plan)
+        if result is not None:
+            result.stages = len(db_stages)
+
+        # 7. Cache snapshot of result, if evolved from empty
+        if fresh and plan[1] and not plan[0]:
+            dbConn.conn.commit()
+            with metrics.phase('snapshot_save'):
+                save_to_cache(db_stages, dbConn)
+        return db_stages
+    finally:
+        dbConn.conn.commit()
+        release_lock(dbConn)
+
+
+# Runs evolutions in-process for an embedding application, returning an
+# EvolutionsResult or raising an exception if they failed.  The database is
+# given as one of: url/user/pw as on the command line; conn, an open DB-API2
+# connection (left open, switched to autocommit while in use, and also used
+# to run scripts); or connect, a factory opening new DB-API2 connections
+# (used for scripts too).  The database type of conn/connect is inferred
+# from the driver unless db_type is given, and scripts are run with the
+# 'dbapi' engine.  Other options are the attributes of Options.
+def run_evolutions(ev_dir, url=None, user='', pw='', conn=None, connect=None,
+                   db_type=None, skip=(), prod_mode=False, **options):
+    opts = Options()
+    for name, value in options.items():
+        if not hasattr(opts, name):
+            raise TypeError("Unknown evolutions option: '" + name + "'")
+        setattr(opts, name, value)
+    opts.skip = set(skip)
+    opts.prod_mode = prod_mode
+
+    given = conn is not None
+    if url is not None:
+        dbConn = get_connection(url, user, pw, opts.engine)
+    elif given or connect is not None:
+        if options.get('engine', 'dbapi') != 'dbapi':
+            raise Exception("The 'client' engine needs a database URL")
+        opts.engine = 'dbapi'
+        if not given:
+            conn = connect()
+        dbConn = wrap_connection(conn, db_type, connect)
+        if opts.snapshot_cache and dbConn.db_type != 'sqlite':
+            # Snapshots are dumped and restored with the command line tools
+            if not given:
+                conn.close()
+            raise Exception('snapshot_cache needs a database URL')
+    else:
+        raise TypeError('One of url, conn or connect is needed')
+    dbConn.set_options(opts)
+
+    saved = get_autocommit(dbConn.conn, dbConn.db_type)
+    if given:
+        set_autocommit(dbConn.conn, dbConn.db_type, True)
+        dbConn.script_conn = dbConn.conn
+    elif dbConn.db_type == 'sqlite':
+        set_autocommit(dbConn.conn, dbConn.db_type, True)
+    if url is None:
+        dbConn.db_name = connection_db_name(dbConn)
+
+    result = EvolutionsResult()
+    result.metrics = dbConn.metrics
+    result.profile = dbConn.profile
+    try:
+        ensure_table(dbConn)
+        do_evolutions(ev_dir, opts.skip, opts.prod_mode, dbConn,
+                      opts.manifest, result=result)
+    finally:
+        dbConn.conn.commit()
+        if given:
+            dbConn.script_conn = None
+            set_autocommit(dbConn.conn, dbConn.db_type, saved)
+        else:
+            dbConn.close()
+    return result
+
+
+# Asyncio variant of run_evolutions(), run in executor (default if None)
+# so as not to block the event loop
+async def run_evolutions_async(ev_dir, executor=None, **kwargs):
+    import asyncio, functools
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(run_evolutions, ev_dir, **kwargs))
+
+
+# An evolved template database, copied to give each test worker its own
+# fully evolved database without running evolutions again.  Clones are made
+# with CREATE DATABASE ... TEMPLATE on Postgres, as a file copy on sqlite,
+# and by copying each table on MySQL (tables only, not views or routines).
+class TemplateDatabase:
+    def __init__(self, url, user, pw, ev_dir, engine='dbapi'):
+        self.url = url
+        self.user = user
+        self.pw = pw
+        self.ev_dir = ev_dir
+        self.engine = engine
+        self.db_type, self.host, self.port, self.db_name = parse_db_url(url)
+        self.key = None # Hash chain of stages template evolved to
+
+    # Evolves template if the evolutions dir changed since last call
+    def prepare(self):
+        dir_stages = scan_dir(self.ev_dir)
+        key = hash_chain(dir_stages)[-1]
+        if key != self.key:
+            with self.sqlite_lock():
+                dbConn = connect_and_ensure(self.url, self.user, self.pw,
+                                            self.engine)
+                try:
+                    do_evolutions(self.ev_dir, set(), False, dbConn,
+                                  dir_stages=dir_stages)
+                finally:
+                    dbConn.conn.commit()
+                    dbConn.close()
+            self.key = key
+        return key
+
+    # Sqlite has no advisory lock, so use a lock file for processes
+    # evolving the same template concurrently
+    @contextlib.contextmanager
+    def sqlite_lock(self):
+        if self.db_type != 'sqlite':
+            yield
+            return
+        import fcntl
+        with open(self.db_name + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Database name (file name for sqlite) of clone with given name
+    def clone_db_name(self, name):
+        if not re.fullmatch(r'[A-Za-z0-9_]+', name):
+            raise Exception("Bad database clone name: '" + name + "'")
+        if self.db_type == 'sqlite':
+            base, ext = path.splitext(self.db_name)
+            return base + '_' + name + ext
+        return self.db_name + '_' + name
+
+    # Creates (or recreates) clone of evolved template with given name (e.g.
+    # the test worker id); returns its URL
+    def clone(self, name):
+        self.prepare()
+        return self.reset(name)
+
+    # Returns clone with given name to the template's state, without checking
+    # whether template needs evolving; returns its URL
+    def reset(self, name):
+        clone_name = self.clone_db_name(name)
+        if self.db_type == 'sqlite':
+            import sqlite3
+            src = sqlite3.connect(self.db_name)
+            dest = sqlite3.connect(clone_name)
+            try:
+                src.backup(dest)
+            finally:
+                dest.close()
+                src.close()
+        elif self.db_type == 'postgresql':
+            self.clone_postgresql(clone_name)
+        else:
+            self.clone_mysql(clone_name)
+        return make_db_url(self.db_type, self.host, self.port, clone_name)
+
+    # Drops clone with given name
+    def drop(self, name):
+        clone_name = self.clone_db_name(name)
+        if self.db_type == 'sqlite':
+            if path.exists(clone_name):
+                os.remove(clone_name)
+        else:
+            conn = self.admin_connection()
+            try:
+                conn.cursor().execute('DROP DATABASE IF EXISTS '
+                                      + self.quote(clone_name))
+            finally:
+                conn.close()
+
+    def quote(self, name):
+        return ('`%s`' if self.db_type == 'mysql' else '"%s"') % (name)
+
+    # Autocommit connection for creating and dropping databases
+    def admin_connection(self, db_name=None):
+        if db_name is None:
+            db_name = 'postgres' if self.db_type == 'postgresql' else self.db_name
+        port = self.port or ('5432' if self.db_type == 'postgresql' else '3306')
+        return open_dbapi(self.db_type, self.host, port, db_name, self.user,
+                          self.pw, True)
+
+    def clone_postgresql(self, clone_name):
+        conn = self.admin_connection()
+        try:
+            db = conn.cursor()
+            db.execute('DROP DATABASE IF EXISTS ' + self.quote(clone_name))
+            # Fails while other sessions use template, e.g. another worker
+            # checking it is evolved, so retry a few times, then copy it
+            # with pg_dump instead (slower, but works while in use)
+            for attempt in range(10):
+                try:
+                    db.execute('CREATE DATABASE %s TEMPLATE %s' % (
+                        self.quote(clone_name), self.quote(self.db_name)))
+                    return
+                except Exception as e:
+                    error = e
+                    time.sleep(0.1 * (attempt + 1))
+            logger.info("Could not clone '%s' as template (%s), copying it"
+                        " with pg_dump", self.db_name, str(error).strip())
+            db.execute('CREATE DATABASE ' + self.quote(clone_name))
+        finally:
+            conn.close()
+        self.copy_postgresql(clone_name)
+
+    # Copies database into (empty) clone through pg_dump and psql
+    def copy_postgresql(self, clone_name):
+        env = dict(os.environ, PGPASSWORD=self.pw)
+        args = ['-h', self.host or 'localhost', '-p', self.port or '5432',
+                '-U', self.user]
+        dump = subprocess.Popen(['pg_dump', '--no-owner', '--no-privileges']
+                                + args + [self.db_name],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        load = subprocess.run(['psql', '-q', '-v', 'ON_ERROR_STOP=1'] + args
+                              + [clone_name], stdin=dump.stdout,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, env=env)
+        dump.stdout.close()
+        dump_error = dump.stderr.read()
+        dump.wait()
+        if dump.returncode != 0 or load.returncode != 0:
+            raise Exception('Copying database failed: ' + (
+                dump_error + load.stderr).decode('utf-8', errors='replace'))
+
+    def clone_mysql(self, clone_name):
+        conn = self.admin_connection()
+        try:
+            db = conn.cursor()
+            db.execute('DROP DATABASE IF EXISTS ' + self.quote(clone_name))
+            db.execute('CREATE DATABASE ' + self.quote(clone_name))
+            db.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+            tables = [ row[0] for row in db.fetchall() ]
+            db.execute('USE ' + self.quote(clone_name))
+            db.execute('SET FOREIGN_KEY_CHECKS = 0')
+            for table in tables:
+                db.execute('SHOW CREATE TABLE %s.%s' % (
+                    self.quote(self.db_name), self.quote(table)))
+                db.execute(db.fetchall()[0][1])
+                db.execute('INSERT INTO %s SELECT * FROM %s.%s' % (
+                    self.quote(table), self.quote(self.db_name),
+                    self.quote(table)))
+        finally:
+            conn.close()
+
+
+# Cumulative hashes of stages' apply hashes: element i identifies the state
+# of a database after running stages 1 to i+1
+def hash_chain(stages):
+    chain = []
+    h = ''
+    for stage in stages:
+        h = hashlib.sha1((h + stage.apply_hash).encode('utf-8')).hexdigest()
+        chain.append(h)
+    return chain
+
+
+# Snapshot file in cache for given hash chain element
+def snapshot_file(dbConn, key):
+    return path.join(dbConn.opts.snapshot_cache, '%s-%s.%s' % (
+        dbConn.db_type, key, 'db' if dbConn.db_type == 'sqlite' else 'sql'))
+
+
+# Restores the snapshot of the longest prefix of dir_stages available in the
+# cache (if any), and records its stages; returns resulting DB stages
+def restore_from_cache(dir_stages, dbConn):
+    chain = hash_chain(dir_stages)
+    for n in range(len(chain), 0, -1):
+        fname = snapshot_file(dbConn, chain[n-1])
+        if path.exists(fname):
+            break
+    else:
+        return []
+    logger.info("Restoring stages 1-%d from snapshot '%s'", n, fname)
+    restore_snapshot(fname, dbConn)
+    dbConn.execute('DELETE FROM evolutions') # Sqlite copy includes table
+    if dbConn.opts.script_store:
+        ensure_script_store(dbConn) # Copy may predate it
+    for stage in dir_stages[0:n]:
+        insert_db(stage, dbConn)
+    return dir_stages[0:n]
+
+
+# Saves snapshot of database (having stages given) to cache, unless there
+# already; failure only warned about
+def save_to_cache(db_stages, dbConn):
+    fname = snapshot_file(dbConn, hash_chain(db_stages)[-1])
+    if path.exists(fname):
+        return
+    try:
+        os.makedirs(dbConn.opts.snapshot_cache, exist_ok=True)
+        save_snapshot(fname, dbConn)
+        logger.info("Saved snapshot '%s'", fname)
+    except Exception as e:
+        logger.warning("Could not save snapshot '%s': %s", fname, e)
+
+
+# Names of tables and views in database other than evolutions' own, logging
+# them if any since the snapshot cache is then not used
+def other_tables(dbConn):
+    if dbConn.db_type == 'sqlite':
+        stmt = ("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"
+                " AND name NOT LIKE 'sqlite%'")
+    else:
+        stmt = ('SELECT table_name FROM information_schema.tables WHERE '
+                + ('table_schema = DATABASE()' if dbConn.db_type == 'mysql'
+                   else "table_schema NOT IN ('pg_catalog',"
+                        " 'information_schema')"))
+    names = [ row[0] for row in dbConn.execute(stmt).fetchall()
+              if row[0].lower() not in ('evolutions', 'evolutions_scripts',
+                                        'evolutions_checkpoints') ]
+    if names:
+        logger.info('Not using snapshot cache, database has other tables: %s',
+                    ', '.join(sorted(names)))
+    return names
+
+
+# Dump command for database, leaving out evolutions tables
+def dump_cmd(dbConn):
+    if dbConn.db_type == 'mysql':
+        return ['mysqldump', '-u', dbConn.user, '--password=' + dbConn.pw,
+                '--routines', '--ignore-table=%s.evolutions' % (dbConn.db_name),
+                '--ignore-table=%s.evolutions_scripts' % (dbConn.db_name),
+                '--ignore-table=%s.evolutions_checkpoints' % (dbConn.db_name),
+                dbConn.db_name]
+    return ['pg_dump', '-h', dbConn.host or 'localhost', '-p', dbConn.port,
+            '-U', dbConn.user, '--no-owner', '--no-privileges',
+            '--exclude-table=evolutions', '--exclude-table=evolutions_scripts',
+            '--exclude-table=evolutions_checkpoints', dbConn.db_name]
+
+
+# Writes dump of database to fname: a copy for sqlite, else SQL script
+def save_snapshot(fname, dbConn):
+    tmp = fname + '.tmp'
+    if dbConn.db_type == 'sqlite':
+        import sqlite3
+        if path.exists(tmp):
+            os.remove(tmp)
+        dest = sqlite3.connect(tmp)
+        try:
+            dbConn.conn.backup(dest)
+        finally:
+            dest.close()
+    else:
+        with open(tmp, 'wb') as f:
+            proc = subprocess.run(dump_cmd(dbConn), env=dbConn.cmd_env,
+                                  stdout=f, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            os.remove(tmp)
+            raise Exception(proc.stderr.decode('utf-8', errors='replace'))
+    os.replace(tmp, fname)
+
+
+# Loads dump written by save_snapshot() into database
+def restore_snapshot(fname, dbConn):
+    if dbConn.db_type == 'sqlite':
+        import sqlite3
+        src = sqlite3.connect(fname)
+        try:
+            src.backup(dbConn.conn)
+        finally:
+            src.close()
+    else:
+        failed, output, error, _ = run_client(batch_cmd(dbConn), dbConn,
+                                              file_chunks(fname, hashlib.sha1()))
+        if failed:
+            raise script_error('snapshot ' + fname, output, error)
+
+
+# Scans and checks stages in dir, normalizing their hashes for db_type if
+# given (see hash_dialect())
+def scan_dir(ev_dir, manifest=None, db_type=None):
+    dir_stages = check_stages(scan_dir_stages(ev_dir, manifest), ev_dir)
     if not dir_stages:
         raise Exception("No evolutions found in dir '" + ev_dir + "'")
+    if db_type is not None:
+        normalize_stages(dir_stages, db_type)
     logger.info("Got %d stages from dir '%s'", len(dir_stages), ev_dir)
     logger.debug('\n\t%s', '\n\t'.join(map(str, dir_stages)))
+    return dir_stages
+
 
-    # 2. Scan DB files
-    db_stages = check_stages(scan_db_stages(dbConn), 'db')
-    logger.info("Got %d stages from DB '%s'", len(db_stages), dbConn.db_name)
-    logger.debug('\n\t%s', '\n'.join(map(str, db_stages)))
+# Database type to normalize hashes for, or None if not normalizing, given
+# Options
+def hash_dialect(db_type, opts):
+    return db_type if opts.normalized_hashes else None
 
-    # 3. Handle skips
-    db_stages = update_for_skips(dir_stages, db_stages, skip, dbConn)
 
-    # 4. Evolve
-    return evolve(dir_stages, db_stages, skip, prod_mode, dbConn)
+# Size in bytes of database
+def db_size(dbConn):
+    if dbConn.db_type == 'postgresql':
+        stmt = 'SELECT pg_database_size(current_database())'
+    elif dbConn.db_type == 'mysql':
+        stmt = ('SELECT SUM(data_length + index_length)'
+                ' FROM information_schema.tables'
+                ' WHERE table_schema = DATABASE()')
+    else:
+        pages = dbConn.execute('PRAGMA page_count').fetchone()[0]
+        return pages * dbConn.execute('PRAGMA page_size').fetchone()[0]
+    return int(dbConn.execute(stmt).fetchone()[0] or 0)
+
+
+# Rehearses evolving a database: works out the plan without changing the
+# database, then runs it on a copy (made as by TemplateDatabase), reporting
+# the time taken by each script, growth in size and any error, and drops
+# the copy.  Returns 0 if evolving the copy succeeded (or was not needed).
+def rehearse(db_url, user, pw, ev_dir, opts):
+    dir_stages = scan_dir(ev_dir, opts.manifest,
+                          hash_dialect(parse_db_url(db_url)[0], opts))
+    dbConn = get_connection(db_url, user, pw, opts.engine)
+    try:
+        try:
+            table_columns(dbConn, 'evolutions')
+            exists = True
+        except Exception:
+            dbConn.conn.rollback()
+            exists = False
+        db_stages = [] # No evolutions table yet
+        if exists:
+            db_stages = check_stages(scan_db_stages(dbConn), 'db',
+                                     opts.selective)
+            convert_hashes(dir_stages, db_stages, dbConn, False)
+    finally:
+        dbConn.close()
+    s = first_difference(dir_stages, db_stages)
+    if not opts.skip and s == len(db_stages) == len(dir_stages):
+        logger.info('Database is up to date, nothing to rehearse.')
+        return 0
+    logger.info("Rehearsing %d downs and %d ups on copy of '%s'",
+                len(db_stages) - s, len(dir_stages) - s, dbConn.db_name)
+
+    copies = TemplateDatabase(db_url, user, pw, ev_dir, opts.engine)
+    name = 'rehearsal_%d' % (os.getpid())
+    report = {'target': db_url, 'ok': False}
+    copyConn = None
+    start = time.time()
+    try:
+        copy_start = time.perf_counter()
+        copy_url = copies.reset(name)
+        report['copy_seconds'] = round(time.perf_counter() - copy_start, 3)
+        copyConn = connect_and_ensure(copy_url, user, pw, opts.engine)
+        copyConn.set_options(opts)
+        copyConn.opts.snapshot_cache = None # Timings wanted, not shortcuts
+        sizes = [db_size(copyConn)]
+        copyConn.stage_hook = lambda stage, which: sizes.append(
+            db_size(copyConn))
+        result = EvolutionsResult()
+        try:
+            do_evolutions(ev_dir, opts.skip, opts.prod_mode, copyConn,
+                          dir_stages=dir_stages, result=result)
+            report['ok'] = True
+        finally:
+            copyConn.conn.commit()
+            sizes.append(db_size(copyConn))
+            report.update(downs=result.downs, ups=result.ups,
+                          size_before=sizes[0], size_after=sizes[-1],
+                          peak_growth=max(sizes) - sizes[0])
+    except Exception as e:
+        report['error'] = str(e)
+    finally:
+        if copyConn is not None:
+            copyConn.close()
+        try:
+            copies.drop(name)
+        except Exception as e:
+            logger.warning("Could not drop copy '%s': %s",
+                           copies.clone_db_name(name), str(e))
+    report['seconds'] = round(time.time() - start, 3)
+
+    metrics = copyConn.metrics if copyConn is not None else Metrics()
+    report['stages'] = metrics.as_dict()['stages']
+    for entry in report['stages']:
+        logger.info('  stage %d %-5s %10.3fs', entry['stage'],
+                    entry['direction'], entry['seconds'])
+    if 'peak_growth' in report:
+        logger.info('Size %d -> %d bytes (peak growth %d bytes)',
+                    report['size_before'], report['size_after'],
+                    report['peak_growth'])
+    if report['ok']:
+        logger.info('Rehearsal succeeded in %.3fs.', report['seconds'])
+    else:
+        logger.warning('Rehearsal FAILED: %s', report['error'])
+    write_metrics([(db_url, report['ok'], metrics)], opts)
+    if opts.report:
+        write_file_atomic(opts.report, json.dumps(report, indent=2) + '\n')
+    return 0 if report['ok'] else 1
+
+
+# Names, sizes and mtimes of scripts in evolutions dir (or of a bundle), to
+# detect changes without reading them
+def dir_state(ev_dir):
+    if path.isfile(ev_dir):
+        st = os.stat(ev_dir)
+        return (st.st_size, st.st_mtime_ns)
+    state = {}
+    with os.scandir(ev_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.sql'):
+                st = entry.stat()
+                state[entry.name] = (st.st_size, st.st_mtime_ns)
+    return state
+
+
+# Evolves database, then again whenever the evolutions dir changes (polled
+# every opts.watch_interval seconds), until interrupted.  The connection is
+# kept open, hashes of unchanged files are kept in memory, and the database
+# is assumed to be as left by the last run unless the dir differs from it.
+def watch(ev_dir, opts, dbConn):
+    hashes = {} # In-memory manifest
+    state = None
+    db_stages = None
+    skip = opts.skip
+    try:
+        while True:
+            new_state = dir_state(ev_dir)
+            if new_state != state:
+                state = new_state
+                try:
+                    dir_stages = scan_dir(ev_dir, hashes, hash_dialect(
+                        dbConn.db_type, dbConn.opts))
+                    db_stages = do_evolutions(ev_dir, skip, opts.prod_mode,
+                                              dbConn, dir_stages=dir_stages,
+                                              db_stages=db_stages)
+                    logger.info('Completed with %d stages; watching for'
+                                ' changes.', len(db_stages))
+                except Exception as e:
+                    logger.warning('Evolutions failed, check output and'
+                                   ' database;\n    exception was: %s', str(e))
+                    db_stages = None
+                finally:
+                    dbConn.conn.commit()
+                skip = set() # Only meant for first run
+            time.sleep(opts.watch_interval)
+    except KeyboardInterrupt:
+        logger.info('Stopped watching.')
+
+
+# Writes files atomically (so readers never see partial content)
+def write_file_atomic(fname, text):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, fname)
+
+
+# Writes statement profiles of runs, given as (db_name, Profile) pairs, to
+# file requested in options
+def write_profile(runs, opts):
+    if opts.profile:
+        write_file_atomic(opts.profile, json.dumps(
+            [ {'db': db, 'scripts': profile.as_dict()}
+              for db, profile in runs if profile is not None ], indent=2)
+            + '\n')
+
+
+# Writes metrics of runs, given as (db_name, ok, Metrics) triples, to files
+# requested in options
+def write_metrics(runs, opts):
+    if opts.metrics_json:
+        write_file_atomic(opts.metrics_json, json.dumps(
+            [ dict(db=db, ok=ok, **metrics.as_dict())
+              for db, ok, metrics in runs ], indent=2) + '\n')
+    if opts.metrics_prom:
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"')
+        lines = []
+        for name, help_text in [
+                ('evolutions_phase_seconds', 'Duration of evolutions run phase'),
+                ('evolutions_stage_seconds', 'Duration of evolutions script'),
+                ('evolutions_success', 'Whether last evolutions run succeeded'),
+                ('evolutions_last_run_timestamp_seconds',
+                 'Time of last evolutions run')]:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % (name))
+            for db, ok, metrics in runs:
+                db = label(db)
+                if name == 'evolutions_phase_seconds':
+                    for phase, secs in sorted(metrics.phases.items()):
+                        lines.append('%s{db="%s",phase="%s"} %.6f'
+                                     % (name, db, phase, secs))
+                elif name == 'evolutions_stage_seconds':
+                    for idx, direction, secs in metrics.stages:
+                        lines.append('%s{db="%s",stage="%d",direction="%s"} %.6f'
+                                     % (name, db, idx, direction, secs))
+                elif name == 'evolutions_success':
+                    lines.append('%s{db="%s"} %d' % (name, db, int(ok)))
+                else:
+                    lines.append('%s{db="%s"} %d' % (name, db, time.time()))
+        write_file_atomic(opts.metrics_prom, '\n'.join(lines) + '\n')
+
+
+# Reads fleet targets file ('-' for stdin): one '<db_url> [<user> [<pass>]]'
+# per line, shell-quoted as needed; blank lines and '#' comments ignored
+def read_targets(fname):
+    if fname == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(fname, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    targets = []
+    for line in lines:
+        fields = shlex.split(line, comments=True)
+        if not fields:
+            continue
+        if len(fields) > 3:
+            raise Exception("Bad fleet target line: '" + line + "'")
+        targets.append((fields + ['', ''])[0:3])
+    return targets
+
+
+# Evolves one fleet target; plans caches plan_evolutions() results keyed by
+# the DB's apply hash chain, so each distinct DB state is only planned once
+def evolve_fleet_target(target, dir_stages, opts, plans):
+    db_url, user, pw = target
+    threading.current_thread().name = db_url # For log output
+    result = {'target': db_url, 'ok': False, 'downs': 0, 'ups': 0}
+    run = EvolutionsResult()
+    start = time.time()
+    dbConn = None
+    try:
+        dbConn = connect_and_ensure(db_url, user, pw, opts.engine)
+        dbConn.set_options(opts)
+        do_evolutions(None, opts.skip, opts.prod_mode, dbConn,
+                      dir_stages=dir_stages, plans=plans, result=run)
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        if dbConn is not None:
+            dbConn.conn.commit()
+            dbConn.close()
+            result['metrics'] = dbConn.metrics
+            result['profile'] = dbConn.profile
+    if run.plan is not None:
+        result.update(downs=len(run.downs), ups=len(run.ups), plan=run.plan)
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+# Evolves all targets listed in file, opts.jobs at a time
+def main_fleet(targets_file, ev_dir, opts):
+    from concurrent.futures import ThreadPoolExecutor
+    targets = read_targets(targets_file)
+    db_types = set([ parse_db_url(t[0])[0] for t in targets ])
+    if opts.normalized_hashes and len(db_types) > 1:
+        raise Exception('Normalized hashes need fleet targets all of one'
+                        ' database type')
+    dir_stages = scan_dir(ev_dir, opts.manifest,
+                          hash_dialect(min(db_types, default=None), opts))
+    plans = {}
+    with ThreadPoolExecutor(opts.jobs) as pool:
+        results = list(pool.map(
+            lambda t: evolve_fleet_target(t, dir_stages, opts, plans), targets))
+
+    failed = [ r for r in results if not r['ok'] ]
+    for r in results:
+        if r['ok']:
+            logger.info('ok     %s: %d downs, %d ups (%.3fs)', r['target'],
+                        r['downs'], r['ups'], r['seconds'])
+        else:
+            logger.warning('FAILED %s: %s', r['target'], r['error'])
+    logger.info('Fleet: %d targets, %d distinct plans, %d failed.',
+                len(results), len(plans), len(failed))
+    write_profile([ (r['target'], r.pop('profile', None)) for r in results ],
+                  opts)
+    write_metrics([ (r['target'], r['ok'], r.pop('metrics', Metrics()))
+                    for r in results ], opts)
+    if opts.report:
+        with open(opts.report, 'w', encoding='utf-8') as f:
+            json.dump({'targets': results, 'failed': len(failed)}, f,
+                      indent=2)
+    return 1 if failed else 0
 
 
 def main(args):
 
     # Arg processing
-    if len(args) < 5 or len(args) > 7:
+    if len(args) >= 3 and args[1].startswith('--fleet='):
+        opts = parse_options(args[3:])
+        if opts is None or not args[1][len('--fleet='):]:
+            return usage(args[0])
+        try:
+            return main_fleet(args[1][len('--fleet='):], args[2], opts)
+        except Exception as e:
+            logger.warning('Fleet evolutions failed; exception was: %s',
+                           str(e))
+            return 1
+
+    if len(args) == 3 and args[1].startswith('--bundle='):
+        if not args[1][len('--bundle='):]:
+            return usage(args[0])
+        try:
+            build_bundle(args[2], args[1][len('--bundle='):])
+            return 0
+        except Exception as e:
+            logger.warning('Building bundle failed; exception was: %s', str(e))
+            return 1
+
+    if len(args) < 5:
         return usage(args[0])
 
     db_url, user, pw, ev_dir = args[1:5]
+    opts = parse_options(args[5:])
+    if opts is None:
+        return usage(args[0])
 
-    skip_arg = '--skip='
-    prod_arg = '--prod'
-    skip = set()
-    prod_mode = False
-    for arg in args[5:]:
-        if arg.startswith(skip_arg):
-            skip = set(map(int, args[5][len(skip_arg):].split(',')))
-            logger.info('Force skip: %s', (','.join(map(str, skip))))
-        elif arg == prod_arg:
-            prod_mode = True
-        else:
-            return usage(args[0])
+    if opts.rehearse:
+        try:
+            return rehearse(db_url, user, pw, ev_dir, opts)
+        except Exception as e:
+            logger.warning('Rehearsal failed; exception was: %s', str(e))
+            return 1
 
     # Connect to DB and ensure evolutions table
-    dbConn = connect_and_ensure(db_url, user, pw)
+    dbConn = connect_and_ensure(db_url, user, pw, opts.engine)
+    dbConn.set_options(opts)
 
     ret = 0
     try:
-        upd_stages = do_evolutions(ev_dir, skip, prod_mode, dbConn)
-        logger.info('Completed with %d stages.', len(upd_stages))
+        if opts.watch:
+            watch(ev_dir, opts, dbConn)
+        else:
+            upd_stages = do_evolutions(ev_dir, opts.skip, opts.prod_mode,
+                                       dbConn, opts.manifest)
+            logger.info('Completed with %d stages.', len(upd_stages))
     except Exception as e:
         logger.warning('Evolutions failed, check output and database;\n'
                        + '    exception was: %s', str(e))
         ret = 1
     finally:
         dbConn.conn.commit()
-        dbConn.conn.close()
+        dbConn.close()
+    write_metrics([(dbConn.db_name, ret == 0, dbConn.metrics)], opts)
+    write_profile([(dbConn.db_name, dbConn.profile)], opts)
 
     return ret
 
 
 if __name__ == "__main__":
+    # Clean, uniform informational and error output, naming the target of
+    # each line when evolving a fleet
+    log_format = 'evolutions: %(message)s'
+    if len(sys.argv) > 1 and sys.argv[1].startswith('--fleet='):
+        log_format = 'evolutions: [%(threadName)s] %(message)s'
+    logging.basicConfig(level='INFO', format=log_format)
     sys.exit(main(sys.argv[:]))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Benchmarks scanning, planning and applying evolutions, on generated
+# evolutions directories and sqlite databases (run in-process, with the
+# dbapi engine unless --engine=client is given).  Invoke from top-level dir:
+#
+#   ./evolutions/test/benchmark.py --stages=500 --size=4096 --out=before.json
+#   ./evolutions/test/benchmark.py --stages=500 --size=4096 --compare=before.json
+#
+# With --compare, exits with 1 if any timing got slower by more than
+# --tolerance relative to the earlier results.
+
+import argparse, json, logging, os, os.path as path, platform, shutil, sys
+import tempfile, time
+
+sys.path.append('.')
+from evolutions import evolutions
+
+
+# Writes stages 1..n to ev_dir, each creating a table and filling it with
+# rows (in one transaction) to make the ups script about size bytes.  Stage
+# changed (if any) gets a different row value, so its hash differs.
+def generate_dir(ev_dir, n, size, changed=None):
+    os.makedirs(ev_dir)
+    for idx in range(1, n + 1):
+        value = 'changed' if idx == changed else 'value'
+        lines = ['CREATE TABLE t_%d (id INT PRIMARY KEY, v TEXT);' % (idx),
+                 'BEGIN;']
+        length = len(lines[0]) + len(lines[1]) + len('COMMIT;')
+        row = 0
+        while length < size:
+            row += 1
+            lines.append("INSERT INTO t_%d (id, v) VALUES (%d, '%s %d');"
+                         % (idx, row, value, row))
+            length += len(lines[-1]) + 1
+        lines.append('COMMIT;')
+        with open(path.join(ev_dir, '%d.sql' % (idx)), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        with open(path.join(ev_dir, '%d-downs.sql' % (idx)), 'w') as f:
+            f.write('DROP TABLE t_%d;\n' % (idx))
+        # Old enough for the manifest to cache
+        for name in ('%d.sql' % (idx), '%d-downs.sql' % (idx)):
+            os.utime(path.join(ev_dir, name), (1e9, 1e9))
+
+
+# Best of repeat timings of fn, with setup (untimed) run before each
+def best_time(fn, repeat, setup=None):
+    best = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return best
+
+
+def connect(db_file, engine):
+    dbConn = evolutions.connect_and_ensure('sqlite:' + db_file, '', '',
+                                           engine)
+    dbConn.opts.lock_wait = 0
+    return dbConn
+
+
+def evolve(ev_dir, db_file, engine, manifest=None):
+    dbConn = connect(db_file, engine)
+    try:
+        evolutions.do_evolutions(ev_dir, set(), False, dbConn, manifest)
+    finally:
+        dbConn.close()
+
+
+def run_benchmarks(args, tmp_dir):
+    ev_dir = path.join(tmp_dir, 'ev')
+    changed_dir = path.join(tmp_dir, 'ev_changed')
+    manifest = path.join(tmp_dir, 'manifest.json')
+    db_file = path.join(tmp_dir, 'bench.db')
+    evolved_file = path.join(tmp_dir, 'evolved.db')
+    changed = args.changed or max(1, args.stages - args.stages // 10)
+    generate_dir(ev_dir, args.stages, args.size)
+    generate_dir(changed_dir, args.stages, args.size, changed)
+
+    def fresh_db():
+        if path.exists(db_file):
+            os.remove(db_file)
+
+    def evolved_db():
+        shutil.copyfile(evolved_file, db_file)
+
+    results = {}
+    results['scan_dir'] = best_time(
+        lambda: evolutions.scan_dir_stages(ev_dir), args.repeat)
+    evolutions.scan_dir_stages(ev_dir, manifest)
+    results['scan_dir_manifest'] = best_time(
+        lambda: evolutions.scan_dir_stages(ev_dir, manifest), args.repeat)
+    bundle = path.join(tmp_dir, 'ev.zip')
+    evolutions.build_bundle(ev_dir, bundle)
+    results['scan_bundle'] = best_time(
+        lambda: evolutions.scan_dir_stages(bundle), args.repeat)
+
+    results['evolve_fresh'] = best_time(
+        lambda: evolve(ev_dir, db_file, args.engine), args.repeat, fresh_db)
+    shutil.copyfile(db_file, evolved_file)
+
+    dbConn = connect(db_file, args.engine)
+    try:
+        results['scan_db'] = best_time(
+            lambda: evolutions.scan_db_stages(dbConn), args.repeat)
+    finally:
+        dbConn.close()
+    results['evolve_noop'] = best_time(
+        lambda: evolve(ev_dir, db_file, args.engine), args.repeat)
+    results['evolve_changed'] = best_time(
+        lambda: evolve(changed_dir, db_file, args.engine), args.repeat,
+        evolved_db)
+
+    evolved_db()
+    results['main_noop'] = best_time(
+        lambda: evolutions.main(['evolutions.py', 'sqlite:' + db_file, '', '',
+                                 ev_dir, '--engine=' + args.engine]),
+        args.repeat)
+    return results
+
+
+# Prints comparison with earlier results, returns names that got slower
+def compare(results, earlier, tolerance):
+    slower = []
+    print('%-20s %12s %12s %8s' % ('benchmark', 'earlier', 'now', 'ratio'))
+    for name, secs in results.items():
+        before = earlier.get(name)
+        if before is None:
+            print('%-20s %12s %12.6f' % (name, '-', secs))
+            continue
+        ratio = secs / before if before > 0 else 1.0
+        flag = ''
+        if ratio > 1 + tolerance:
+            slower.append(name)
+            flag = ' SLOWER'
+        print('%-20s %12.6f %12.6f %8.2f%s' % (name, before, secs, ratio, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark evolutions')
+    parser.add_argument('--stages', type=int, default=200,
+                        help='number of stages to generate (200)')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='approximate bytes per ups script (2048)')
+    parser.add_argument('--changed', type=int, default=None,
+                        help='stage changed for evolve_changed (90%% through)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each benchmark, best is taken (3)')
+    parser.add_argument('--engine', choices=['dbapi', 'client'],
+                        default='dbapi', help='script engine (dbapi)')
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--compare', help='earlier JSON results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown allowed by --compare (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(args, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {'params': {'stages': args.stages, 'size': args.size,
+                         'changed': args.changed, 'repeat': args.repeat,
+                         'engine': args.engine},
+              'python': platform.python_version(),
+              'results': { k: round(v, 6) for k, v in results.items() }}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            earlier = json.load(f)
+        if earlier.get('params') != report['params']:
+            print('warning: comparing results with different parameters',
+                  file=sys.stderr)
+        slower = compare(report['results'], earlier['results'],
+                         args.tolerance)
+        return 1 if slower else 0
+    for name, secs in report['results'].items():
+        print('%-20s %12.6f' % (name, secs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,7 @@
+CREATE TABLE soup (
+    id    INT PRIMARY KEY,
+    name  VARCHAR(64) NOT NULL
+  );
+
+INSERT INTO soup (id, name) VALUES (1, 'Lentil');
+INSERT INTO soup (id, name) VALUES (2, 'Minestrone');
@@ -0,0 +1 @@
+UPDATE nums SET v = 0;
@@ -0,0 +1,2 @@
+-- evolutions:chunked key=nums.id rows=10
+UPDATE nums SET v = v + 1 WHERE id >= :batch_lo AND id < :batch_hi;
@@ -0,0 +1,2 @@
+DROP TABLE par_a;
+DROP TABLE par_b;
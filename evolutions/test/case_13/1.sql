@@ -0,0 +1,16 @@
+CREATE TABLE par_a (
+    id  INT PRIMARY KEY,
+    v   INT NOT NULL
+  );
+CREATE TABLE par_b (
+    id  INT PRIMARY KEY,
+    v   INT NOT NULL
+  );
+
+-- evolutions:parallel
+CREATE INDEX par_a_v ON par_a (v);
+CREATE INDEX par_b_v ON par_b (v);
+INSERT INTO par_a (id, v) VALUES (1, 1);
+-- evolutions:end-parallel
+
+INSERT INTO par_b (id, v) VALUES (1, 1);
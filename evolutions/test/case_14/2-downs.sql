@@ -0,0 +1 @@
+DELETE FROM par_a WHERE id = 2;
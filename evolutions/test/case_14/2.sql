@@ -0,0 +1,5 @@
+-- evolutions:parallel
+INSERT INTO no_such_table_1 (id) VALUES (1);
+INSERT INTO par_a (id, v) VALUES (2, 2);
+INSERT INTO no_such_table_2 (id) VALUES (1);
+-- evolutions:end-parallel
@@ -0,0 +1 @@
+drop TABLE soup;
@@ -0,0 +1,9 @@
+-- Soups, reformatted
+create table soup (
+  id INT primary key,
+  name VARCHAR(64) not null
+);
+
+insert into soup (id, name) values (1, 'Lentil');
+insert into soup (id, name)
+  values (2, 'Minestrone'); /* Italian */
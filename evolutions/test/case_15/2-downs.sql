@@ -0,0 +1 @@
+delete from soup where id = 3;
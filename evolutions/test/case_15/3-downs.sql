@@ -0,0 +1 @@
+DELETE FROM soup WHERE id = 4;
@@ -0,0 +1 @@
+INSERT INTO soup (id, name) VALUES (4, 'Onion');
@@ -0,0 +1,6 @@
+CREATE TABLE soup (
+    id    INT PRIMARY KEY,
+    name  VARCHAR(64) NOT NULL
+  );
+
+INSERT INTO soup (id, name) VALUES (1, 'Lentil');
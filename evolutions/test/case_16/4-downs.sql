@@ -0,0 +1 @@
+DELETE FROM bread WHERE id = 2;
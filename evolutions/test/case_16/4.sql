@@ -0,0 +1 @@
+INSERT INTO bread (id, name) SELECT 2, name FROM soup WHERE id = 1;
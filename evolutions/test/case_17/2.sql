@@ -0,0 +1,6 @@
+CREATE TABLE bread (
+    id    INT PRIMARY KEY,
+    name  VARCHAR(64) NOT NULL
+  );
+
+INSERT INTO bread (id, name) VALUES (1, 'Spelt');
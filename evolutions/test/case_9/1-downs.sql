@@ -0,0 +1 @@
+DROP table soup;
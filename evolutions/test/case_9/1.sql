@@ -0,0 +1,8 @@
+-- Statement splitting must respect quoting and comments; 'even here'
+CREATE TABLE soup (
+    id    INT PRIMARY KEY,  /* a ; inside a block comment */
+    name  VARCHAR(64) NOT NULL
+  );
+
+INSERT INTO soup (id, name) VALUES (1, 'Lentil; with ''bacon''');
+INSERT INTO soup (id, name) VALUES (2, '-- not a comment');
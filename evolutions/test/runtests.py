@@ -2,7 +2,7 @@
 
 # Invoke from top-level dir
 
-import os, os.path as path, subprocess, sys, unittest
+import json, os, os.path as path, shutil, subprocess, sys, tempfile, unittest
 
 sys.path.append('.')
 
@@ -27,6 +27,12 @@ class TestEvolutions_MySQL(unittest.TestCase):
     def tearDownClass(cls):
         cls.do_db_check(cls, "DROP TABLE soup;")
         cls.do_db_check(cls, "DROP TABLE evolutions;")
+        cls.do_db_check(cls, "DROP TABLE IF EXISTS evolutions_scripts;")
+        cls.do_db_check(cls, "DROP TABLE IF EXISTS evolutions_checkpoints;")
+        cls.do_db_check(cls, "DROP TABLE IF EXISTS nums;")
+        cls.do_db_check(cls, "DROP TABLE IF EXISTS par_a;")
+        cls.do_db_check(cls, "DROP TABLE IF EXISTS par_b;")
+        cls.do_db_check(cls, "DROP TABLE IF EXISTS bread;")
 
 
     def do_db_check(self, query, expected_result=None):
@@ -44,6 +50,17 @@ class TestEvolutions_MySQL(unittest.TestCase):
     def setUp(self):
         print("\nTest '%s'\n" % (self._testMethodName), file=sys.stderr)
 
+    # For tests not part of the test_case_* sequence
+    def reset_db(self):
+        self.do_db_check("DROP TABLE IF EXISTS soup;")
+        self.do_db_check("DROP TABLE IF EXISTS evolutions;")
+        self.do_db_check("DROP TABLE IF EXISTS evolutions_scripts;")
+        self.do_db_check("DROP TABLE IF EXISTS evolutions_checkpoints;")
+        self.do_db_check("DROP TABLE IF EXISTS nums;")
+        self.do_db_check("DROP TABLE IF EXISTS par_a;")
+        self.do_db_check("DROP TABLE IF EXISTS par_b;")
+        self.do_db_check("DROP TABLE IF EXISTS bread;")
+
 
     # Load a single stage correctly, no-op on rerun
     def test_case_1(self):
@@ -107,6 +124,306 @@ class TestEvolutions_MySQL(unittest.TestCase):
                                              '--prod'])
         self.do_db_check("SELECT COUNT(*) FROM evolutions;", "5")
 
+    # Run scripts in-process, including changes needing downs
+    def test_engine_dbapi(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_9',
+                                             '--engine=dbapi'])
+        self.do_db_check("SELECT COUNT(*) FROM soup WHERE name LIKE '%;%';",
+                         "1")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_3',
+                                             '--engine=dbapi'])
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_8',
+                                             '--engine=dbapi'])
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "6")
+        # Script errors fail the run
+        self.reset_db()
+        ret = subprocess.call(self.db_cmd + ['evolutions/test/case_10',
+                                             '--engine=dbapi'])
+        self.assertEqual(ret, 1)
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "0")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_9',
+                                             '--engine=dbapi'])
+
+    # Run all downs and ups through one client session
+    def test_engine_batch(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_7',
+                                             '--batch'])
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "6")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_8',
+                                             '--batch'])
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "6")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "5")
+        # Stages before a failing one are recorded, later ones not run
+        self.reset_db()
+        ret = subprocess.call(self.db_cmd + ['evolutions/test/case_11',
+                                             '--batch'])
+        self.assertEqual(ret, 1)
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "2")
+        self.do_db_check("SELECT id FROM evolutions;", "1")
+
+    # Scripts over store limit are not stored, files used for downs instead
+    def test_store_limit(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_2',
+                                             '--store-limit=10'])
+        self.do_db_check("SELECT COUNT(*) FROM evolutions"
+                         " WHERE revert_script LIKE '-- evolutions:%';", "3")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_3'])
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "5")
+
+        # Changed downs not stored fail the run before any downs are run
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_2',
+                                             '--store-limit=10'])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ev_dir = path.join(tmp_dir, 'ev')
+            shutil.copytree('evolutions/test/case_2', ev_dir)
+            for name in ('2.sql', '2-downs.sql'):
+                with open(path.join(ev_dir, name), 'a') as f:
+                    f.write('SELECT 1;\n')
+            ret = subprocess.call(self.db_cmd + [ev_dir])
+            self.assertEqual(ret, 1)
+            self.do_db_check("SELECT COUNT(*) FROM evolutions;", "3")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    # Scripts are not kept in memory once run and recorded, stages read from
+    # the evolutions table have no scripts loaded, and only the downs scripts
+    # of stages reverted are fetched
+    def test_lazy_db_scripts(self):
+        from unittest import mock
+        from evolutions import evolutions
+        self.reset_db()
+        dbConn = evolutions.connect_and_ensure(*self.db_cmd[1:4])
+        try:
+            dir_stages = evolutions.scan_dir('evolutions/test/case_2')
+            evolutions.do_evolutions('evolutions/test/case_2', set(), False,
+                                     dbConn, dir_stages=dir_stages)
+            self.assertEqual([ stage.scripts for stage in dir_stages ],
+                             [{}, {}, {}])
+            stages = evolutions.scan_db_stages(dbConn)
+            self.assertEqual([ stage.idx for stage in stages ], [1, 2, 3])
+            for stage in stages:
+                self.assertNotIn('apply', stage.scripts)
+                self.assertNotIn('revert', stage.scripts)
+            with mock.patch.object(evolutions, 'load_db_script',
+                                   wraps=evolutions.load_db_script) as load:
+                evolutions.do_evolutions('evolutions/test/case_1', set(),
+                                         False, dbConn)
+            self.assertEqual({ call.args[0:2] for call in load.call_args_list },
+                             {(2, 'revert'), (3, 'revert')})
+        finally:
+            dbConn.conn.commit()
+            dbConn.close()
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "1")
+
+    # Scripts kept in store instead of evolutions table, existing rows moved
+    def test_script_store(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_2'])
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_2',
+                                             '--script-store'])
+        self.do_db_check("SELECT COUNT(*) FROM evolutions"
+                         " WHERE apply_script IS NULL"
+                         " AND revert_script IS NULL;", "3")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_3',
+                                             '--script-store'])
+        self.do_db_check("SELECT COUNT(*) FROM evolutions"
+                         " WHERE apply_script IS NOT NULL;", "0")
+        # Downs of stages missing from dir loaded from store, without option
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_1'])
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "2")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "1")
+
+    # Normalized hashes: raw hashes converted (and back) without rerunning
+    # stages, cosmetic edits ignored, others still rerun
+    def test_normalized_hashes(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_2'])
+        self.do_db_check("INSERT INTO soup (id, name) VALUES (9, 'Kept');")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_15',
+                                             '--normalized-hashes'])
+        self.do_db_check("SELECT COUNT(*) FROM soup WHERE id = 9;", "1")
+        self.do_db_check("SELECT name FROM soup WHERE id = 4;", "Onion")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions"
+                         " WHERE apply_hash LIKE 'n:%';", "3")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_2'])
+        self.do_db_check("SELECT COUNT(*) FROM soup WHERE id = 9;", "1")
+        self.do_db_check("SELECT name FROM soup WHERE id = 4;",
+                         "French Onion")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions"
+                         " WHERE apply_hash LIKE 'n:%';", "0")
+
+    # Selective rollback: stage touching only other tables not rerun
+    def test_selective(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_16'])
+        self.do_db_check("UPDATE soup SET name = 'Kept' WHERE id = 2;")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_17',
+                                             '--selective'])
+        self.do_db_check("SELECT name FROM soup WHERE id = 2;", "Kept")
+        self.do_db_check("SELECT name FROM bread WHERE id = 1;", "Spelt")
+        self.do_db_check("SELECT name FROM bread WHERE id = 2;", "Lentil")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "4")
+        # Gap in evolutions table only filled in by selective runs
+        self.do_db_check("DELETE FROM evolutions WHERE id = 3;")
+        self.do_db_check("DELETE FROM soup WHERE id = 2;")
+        ret = subprocess.call(self.db_cmd + ['evolutions/test/case_17'])
+        self.assertEqual(ret, 1)
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_17',
+                                             '--selective'])
+        self.do_db_check("SELECT name FROM soup WHERE id = 2;", "Tomato")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "4")
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_16'])
+        self.do_db_check("SELECT name FROM soup WHERE id = 2;", "Tomato")
+        self.do_db_check("SELECT name FROM bread WHERE id = 1;", "Rye")
+
+    # Chunked stage run in key ranges, and resumed from its checkpoint
+    def test_chunked(self):
+        import hashlib
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_12',
+                                             '--chunk-sleep=0.01'])
+        self.do_db_check("SELECT COUNT(*) FROM nums WHERE v = 1;", "25")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "2")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions_checkpoints;", "0")
+
+        # As if interrupted after the first two chunks
+        with open('evolutions/test/case_12/2.sql', 'rb') as f:
+            h = hashlib.sha1(f.read()).hexdigest()
+        self.do_db_check("UPDATE nums SET v = 0;")
+        self.do_db_check("DELETE FROM evolutions WHERE id = 2;")
+        self.do_db_check("INSERT INTO evolutions_checkpoints VALUES"
+                         " (2, '%s', 21, 26, CURRENT_TIMESTAMP);" % (h))
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_12',
+                                             '--engine=dbapi'])
+        self.do_db_check("SELECT COUNT(*) FROM nums WHERE v = 1;", "5")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "2")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions_checkpoints;", "0")
+
+    # Parallel block run with all its failures reported, with either engine
+    def test_parallel(self):
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_13'])
+        self.do_db_check("SELECT COUNT(*) FROM par_a;", "1")
+        self.do_db_check("SELECT COUNT(*) FROM par_b;", "1")
+        proc = subprocess.run(self.db_cmd + ['evolutions/test/case_14',
+                                             '--engine=dbapi', '--parallel=2'],
+                              stderr=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn(b'no_such_table_1', proc.stderr)
+        self.assertIn(b'no_such_table_2', proc.stderr)
+        self.do_db_check("SELECT COUNT(*) FROM par_a;", "2")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "1")
+
+    # Concurrent runs wait for each other, and then find nothing to do
+    def test_concurrent_runs(self):
+        if self.db_cmd[1].startswith('sqlite:'):
+            self.skipTest('no locking with sqlite')
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_1'])
+        procs = [ subprocess.Popen(self.db_cmd + ['evolutions/test/case_7'])
+                  for i in range(4) ]
+        self.assertEqual([ proc.wait() for proc in procs ], [0, 0, 0, 0])
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "6")
+        self.do_db_check("SELECT COUNT(*) FROM evolutions;", "5")
+
+    # Timings recorded, in evolutions table and metrics files
+    def test_metrics(self):
+        self.reset_db()
+        # Table from older version gets new column
+        self.do_db_check("CREATE TABLE evolutions (id INT NOT NULL PRIMARY KEY,"
+                         " applied_at TIMESTAMP NOT NULL,"
+                         " apply_hash VARCHAR(64) NOT NULL,"
+                         " revert_hash VARCHAR(64) NOT NULL,"
+                         " apply_script TEXT, revert_script TEXT);")
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            json_file = path.join(tmp_dir, 'metrics.json')
+            prom_file = path.join(tmp_dir, 'metrics.prom')
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_2',
+                                                 '--metrics-json=' + json_file,
+                                                 '--metrics-prom=' + prom_file])
+            with open(json_file) as f:
+                metrics = json.load(f)[0]
+            self.assertTrue(metrics['ok'])
+            self.assertEqual([ s['stage'] for s in metrics['stages'] ],
+                             [1, 2, 3])
+            self.assertTrue({'scan_dir', 'scan_db', 'lock_wait', 'evolve'}
+                            <= set(metrics['phases']))
+            with open(prom_file) as f:
+                self.assertIn('direction="ups"', f.read())
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.do_db_check("SELECT COUNT(*) FROM evolutions"
+                         " WHERE apply_ms IS NOT NULL;", "3")
+
+    # Statements timed one by one, slowest listed per script
+    def test_profile(self):
+        self.reset_db()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            profile_file = path.join(tmp_dir, 'profile.json')
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_2',
+                                                 '--profile=' + profile_file,
+                                                 '--profile-top=2',
+                                                 '--profile-explain=0'])
+            with open(profile_file) as f:
+                scripts = json.load(f)[0]['scripts']
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual([ (s['stage'], s['direction']) for s in scripts ],
+                         [(1, 'ups'), (2, 'ups'), (3, 'ups')])
+        self.assertEqual(scripts[0]['statements'], 3)
+        top = scripts[0]['top']
+        self.assertEqual(len(top), 2)
+        self.assertGreaterEqual(top[0]['seconds'], top[1]['seconds'])
+        for entry in top:
+            if entry['sql'].startswith('INSERT'):
+                self.assertEqual(entry['rows'], 1)
+                self.assertIsNotNone(entry['plan'])
+
+    # Snapshot of evolved database restored into an empty one
+    def test_snapshot_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache_arg = '--snapshot-cache=' + cache_dir
+            self.reset_db()
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_3',
+                                                 cache_arg])
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # Stages 1-4 same as case_3, so only 5 run
+            self.reset_db()
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_7',
+                                                 cache_arg])
+            self.do_db_check("SELECT COUNT(*) FROM soup;", "6")
+            self.do_db_check("SELECT COUNT(*) FROM evolutions;", "5")
+            self.do_db_check("SELECT id FROM evolutions"
+                             " WHERE apply_ms IS NOT NULL;", "5")
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # Database not evolved from empty: not snapshotted
+            self.reset_db()
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_1'])
+            self.do_db_check("INSERT INTO soup VALUES (99, 'dev row');")
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_2',
+                                                 cache_arg])
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # Other tables: snapshot not restored over them
+            self.reset_db()
+            self.do_db_check("CREATE TABLE bread (id INT);")
+            self.do_db_check("INSERT INTO bread VALUES (1);")
+            subprocess.check_call(self.db_cmd + ['evolutions/test/case_7',
+                                                 cache_arg])
+            self.do_db_check("SELECT COUNT(*) FROM bread;", "1")
+            self.do_db_check("SELECT COUNT(*) FROM soup;", "6")
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 class TestEvolutions_PostgreSQL(TestEvolutions_MySQL):
 
@@ -135,6 +452,512 @@ class TestEvolutions_Sqlite(TestEvolutions_MySQL):
         cls.db_check_cmd = ['sqlite3', path.join('evolutions', 'test', db_name)]
         print("\nSqlite Tests\n", file=sys.stderr)
 
+    # Script blocked by another writer times out, and is retried until the
+    # other writer is done
+    def test_lock_retries(self):
+        import sqlite3, time
+        self.reset_db()
+        subprocess.check_call(self.db_cmd + ['evolutions/test/case_1'])
+        conn = sqlite3.connect(path.join('evolutions', 'test', 'evtest.db'),
+                               isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            proc = subprocess.Popen(self.db_cmd + [
+                'evolutions/test/case_2', '--stage-lock-timeout=100',
+                '--lock-retries=5', '--retry-backoff=0.2'],
+                stderr=subprocess.PIPE)
+            time.sleep(1)
+            conn.execute('COMMIT')
+            _, err = proc.communicate()
+        finally:
+            conn.close()
+        self.assertEqual(proc.returncode, 0)
+        self.assertIn(b'failed on lock timeout, retry 1 of 5', err)
+        self.do_db_check("SELECT COUNT(*) FROM soup;", "4")
+
+
+# Statement splitting for the in-process engine (no database needed)
+class TestSplitSql(unittest.TestCase):
+
+    def test_quotes_and_comments(self):
+        from evolutions.evolutions import split_sql
+        script = ("-- lead; comment\nINSERT INTO t VALUES ('a;b', \"c;d\");\n"
+                  "/* x; */ SELECT 1 # not mysql comment;\n;;")
+        self.assertEqual(split_sql(script, 'sqlite'),
+                         ["-- lead; comment\nINSERT INTO t VALUES ('a;b', \"c;d\")",
+                          "/* x; */ SELECT 1 # not mysql comment"])
+        self.assertEqual(split_sql("SELECT 'it''s; ok'; SELECT 2", 'sqlite'),
+                         ["SELECT 'it''s; ok'", "SELECT 2"])
+
+    def test_postgresql(self):
+        from evolutions.evolutions import split_sql
+        script = ("CREATE FUNCTION f() RETURNS INT AS $body$\n"
+                  "BEGIN RETURN 1; END; $body$ LANGUAGE plpgsql;\n"
+                  "SELECT E'x\\'; y', $$;$$, $1; /* a /* b; */ c; */")
+        self.assertEqual(len(split_sql(script, 'postgresql')), 2)
+
+    def test_mysql(self):
+        from evolutions.evolutions import split_sql
+        script = ("INSERT INTO t VALUES ('a\\';b'); # c;\n"
+                  "DELIMITER //\n"
+                  "CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END//\n"
+                  "DELIMITER ;\n"
+                  "SELECT 3;")
+        self.assertEqual(split_sql(script, 'mysql'),
+                         ["INSERT INTO t VALUES ('a\\';b')",
+                          "# c;\nCREATE PROCEDURE p() BEGIN SELECT 1; "
+                          "SELECT 2; END",
+                          "SELECT 3"])
+        self.assertEqual(split_sql("DELIMITER $$\nCREATE PROCEDURE p() BEGIN"
+                                   " SELECT 1; END$$\nDELIMITER ;\nSELECT 2;",
+                                   'mysql'),
+                         ["CREATE PROCEDURE p() BEGIN SELECT 1; END",
+                          "SELECT 2"])
+        # Executable comments and optimizer hints are SQL
+        self.assertEqual(split_sql("/*!40101 SET NAMES utf8 */;\n"
+                                   "SELECT /*+ NO_ICP(t) */ 1;", 'mysql'),
+                         ["/*!40101 SET NAMES utf8 */",
+                          "SELECT /*+ NO_ICP(t) */ 1"])
+
+    def test_sqlite_trigger(self):
+        from evolutions.evolutions import split_sql
+        script = ("CREATE TRIGGER t AFTER INSERT ON a BEGIN\n"
+                  "  INSERT INTO b VALUES (1); INSERT INTO b VALUES (2);\n"
+                  "END; SELECT 1;")
+        self.assertEqual(len(split_sql(script, 'sqlite')), 2)
+
+    def test_normalized_hash(self):
+        from evolutions.evolutions import normalized_hash
+        h = normalized_hash("INSERT INTO Soup VALUES ('A  b'); -- x\n", 'mysql')
+        self.assertEqual(h, normalized_hash(
+            "# Soups\ninsert  into Soup\n  values('A  b');", 'mysql'))
+        for other in ("INSERT INTO soup VALUES ('A  b');",
+                      "INSERT INTO Soup VALUES ('a b');",
+                      "INSERT INTO Soup VALUES ('A  b'); -- evolutions:x"):
+            self.assertNotEqual(h, normalized_hash(other, 'mysql'))
+        self.assertNotEqual(normalized_hash("/*!40101 SET x=1 */;", 'mysql'),
+                            normalized_hash("/*!40101 SET x=2 */;", 'mysql'))
+
+    def test_script_objects(self):
+        from evolutions.evolutions import script_objects
+        script = ("CREATE UNIQUE INDEX IF NOT EXISTS ix ON public.soup (name);\n"
+                  "ALTER TABLE soup RENAME TO potage;\n"
+                  "INSERT INTO \"Bread\" (id) SELECT s.id FROM potage s;\n"
+                  "UPDATE a JOIN b ON a.id = b.id SET a.v = 1 WHERE b.w = 2;\n"
+                  "BEGIN; DELETE FROM c; COMMIT;")
+        reads, writes = script_objects(script, 'mysql')
+        self.assertEqual(writes, {'ix', 'soup', 'potage', 'bread', 'a', 'b',
+                                  'c', 'id'})
+        self.assertEqual(reads, {'name', 's', 'v', 'w'})
+        self.assertIsNone(script_objects(
+            "CREATE FUNCTION f() RETURNS INT AS $$ SELECT 1 $$"
+            " LANGUAGE sql;", 'postgresql'))
+        self.assertIsNone(script_objects("CALL p();", 'mysql'))
+        self.assertEqual(script_objects(
+            "-- evolutions:touches soup, bread\nCALL p();", 'mysql'),
+            (set(), {'soup', 'bread'}))
+
+
+# Client output handling, with a shell standing in for the client
+class TestRunClient(unittest.TestCase):
+
+    # Stderr output is put down to the script after the last marker
+    def test_error_markers(self):
+        from evolutions.evolutions import run_client, _batch_warning_re
+        class Conn:
+            cmd_env = None
+        state = { 'done': 0, 'first': None }
+        failed, output, error, _ = run_client(
+            ['sh', '-c', 'cat >/dev/null;'
+             ' echo "psql:<stdin>:3: WARNING:  evolutions:done:0" >&2;'
+             ' echo "psql:<stdin>:5: NOTICE:  table b exists" >&2;'
+             ' echo "psql:<stdin>:7: WARNING:  evolutions:done:1" >&2'],
+            Conn(), [b'SELECT 1;\n'], None, _batch_warning_re, state)
+        self.assertTrue(failed)
+        self.assertEqual(error, 'psql:<stdin>:5: NOTICE:  table b exists\n')
+        self.assertEqual(state, { 'done': 2, 'first': 1 })
+        state = { 'done': 0, 'first': None }
+        failed, _, error, _ = run_client(
+            ['sh', '-c', 'cat >/dev/null;'
+             ' echo "WARNING:  evolutions:done:0" >&2'],
+            Conn(), [], None, _batch_warning_re, state)
+        self.assertFalse(failed)
+        self.assertEqual(state, { 'done': 1, 'first': None })
+
+    # Text passed to the client as SQL literals comes back unchanged
+    def test_sql_literal(self):
+        import sqlite3
+        from evolutions.evolutions import sql_literal
+        conn = sqlite3.connect(':memory:')
+        try:
+            for text in ("it's\n\tplain", 'back\\slash', 'caf\u00e9'):
+                self.assertEqual(conn.execute(
+                    'SELECT ' + sql_literal(text, 'sqlite')).fetchone()[0], text)
+        finally:
+            conn.close()
+        self.assertEqual(sql_literal(None, 'mysql'), 'NULL')
+        self.assertEqual(sql_literal('\\', 'mysql'),
+                         "CONVERT(X'5c' USING utf8mb4)")
+
+
+# Directory scanning and hash manifest (no database needed)
+class TestScanDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ev_dir = path.join(self.tmp_dir, 'ev')
+        shutil.copytree('evolutions/test/case_2', self.ev_dir)
+        for name in os.listdir(self.ev_dir):  # Old enough to be cached
+            os.utime(path.join(self.ev_dir, name), (1e9, 1e9))
+        self.manifest = path.join(self.tmp_dir, 'manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_manifest(self):
+        from evolutions.evolutions import scan_dir_stages, scan_file
+        stages = scan_dir_stages(self.ev_dir, self.manifest)
+        self.assertEqual([ s.idx for s in stages ], [1, 2, 3])
+        ups_1 = path.join(self.ev_dir, '1.sql')
+        self.assertEqual(stages[0].apply_hash, scan_file(ups_1)[0])
+        self.assertNotIn('apply', stages[0].scripts)
+        self.assertEqual(stages[0].parallel, {'apply': False, 'revert': False})
+        with open(ups_1) as f:
+            self.assertEqual(stages[0].apply_script, f.read())
+
+        # Unchanged size and mtime: hash taken from manifest
+        with open(self.manifest) as f:
+            data = json.load(f)
+        self.assertEqual(len(data['files']), 6)
+        data['files'][path.abspath(ups_1)][2:4] = ['cached', True]
+        with open(self.manifest, 'w') as f:
+            json.dump(data, f)
+        stages = scan_dir_stages(self.ev_dir, self.manifest)
+        self.assertEqual(stages[0].apply_hash, 'cached')
+        self.assertTrue(stages[0].parallel['apply'])
+
+        # Changed mtime: rehashed, and script checked against hash
+        os.utime(ups_1, (2e9, 2e9))
+        stages = scan_dir_stages(self.ev_dir, self.manifest)
+        self.assertEqual(stages[0].apply_hash, scan_file(ups_1)[0])
+        with open(ups_1, 'a') as f:
+            f.write('\n')
+        self.assertRaises(Exception, lambda: stages[0].apply_script)
+
+
+# Bundle built from directory, and used in its place
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bundle = path.join(self.tmp_dir, 'ev.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bundle(self):
+        import sqlite3, zipfile
+        from evolutions.evolutions import scan_dir_stages
+        subprocess.check_call(['./evolutions/evolutions.py',
+                               '--bundle=' + self.bundle,
+                               'evolutions/test/case_2'])
+        stages = scan_dir_stages(self.bundle)
+        dir_stages = scan_dir_stages('evolutions/test/case_2')
+        self.assertEqual([ (s.idx, s.apply_hash, s.revert_hash)
+                           for s in stages ],
+                         [ (s.idx, s.apply_hash, s.revert_hash)
+                           for s in dir_stages ])
+        self.assertNotIn('apply', stages[0].scripts)
+        self.assertEqual(stages[2].revert_script, dir_stages[2].revert_script)
+
+        db_file = path.join(self.tmp_dir, 'b.db')
+        subprocess.check_call(['./evolutions/evolutions.py', 'sqlite:' + db_file,
+                               '', '', self.bundle])
+        conn = sqlite3.connect(db_file)
+        try:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM soup')
+                             .fetchone()[0], 4)
+        finally:
+            conn.close()
+
+        # Script not matching manifest
+        tampered = path.join(self.tmp_dir, 'tampered.zip')
+        with zipfile.ZipFile(self.bundle) as src, \
+             zipfile.ZipFile(tampered, 'w') as dest:
+            for name in src.namelist():
+                data = src.read(name)
+                dest.writestr(name, data + b'\n' if name == '1.sql' else data)
+        stages = scan_dir_stages(tampered)
+        self.assertEqual(stages[0].apply_hash, dir_stages[0].apply_hash)
+        self.assertRaises(Exception, lambda: stages[0].apply_script)
+
+
+# Watch mode evolving again as files change, using sqlite
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_watch(self):
+        import signal, time
+        ev_dir = path.join(self.tmp_dir, 'ev')
+        shutil.copytree('evolutions/test/case_1', ev_dir)
+        log_file = path.join(self.tmp_dir, 'log.txt')
+
+        def log_has(text, count=1):
+            for i in range(100):
+                with open(log_file) as f:
+                    if f.read().count(text) >= count:
+                        return True
+                time.sleep(0.1)
+            return False
+
+        with open(log_file, 'w') as log:
+            proc = subprocess.Popen(['./evolutions/evolutions.py',
+                                     'sqlite:' + path.join(self.tmp_dir, 'w.db'),
+                                     '', '', ev_dir, '--watch',
+                                     '--watch-interval=0.1'], stderr=log)
+        try:
+            self.assertTrue(log_has('Completed with 1 stages'))
+            for name in ('2.sql', '2-downs.sql', '3.sql', '3-downs.sql'):
+                shutil.copy(path.join('evolutions/test/case_2', name), ev_dir)
+            self.assertTrue(log_has('Completed with 3 stages'))
+
+            # Only changed stage run again
+            with open(path.join(ev_dir, '3.sql'), 'a') as f:
+                f.write('\n-- changed\n')
+            self.assertTrue(log_has('Completed with 3 stages', 2))
+        finally:
+            proc.send_signal(signal.SIGINT)
+            self.assertEqual(proc.wait(), 0)
+        with open(log_file) as f:
+            log = f.read()
+        self.assertEqual(log.count('Running downs'), 1)
+        self.assertIn('Running downs for stage 3', log)
+        self.assertEqual(log.count('Running ups for stage 3'), 2)
+        self.assertIn('Stopped watching.', log)
+
+
+# Rehearsal on a copy of the database, using sqlite
+class TestRehearse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = path.join(self.tmp_dir, 'r.db')
+        self.report = path.join(self.tmp_dir, 'report.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def rehearse(self, ev_dir):
+        ret = subprocess.call(['./evolutions/evolutions.py',
+                               'sqlite:' + self.db_file, '', '', ev_dir,
+                               '--rehearse', '--report=' + self.report])
+        with open(self.report) as f:
+            return ret, json.load(f)
+
+    def test_rehearse(self):
+        import sqlite3
+        # No evolutions table yet: every stage rehearsed
+        ret, report = self.rehearse('evolutions/test/case_2')
+        self.assertEqual(ret, 0)
+        self.assertEqual((report['downs'], report['ups']), ([], [1, 2, 3]))
+        os.remove(self.report)
+
+        subprocess.check_call(['./evolutions/evolutions.py',
+                               'sqlite:' + self.db_file, '', '',
+                               'evolutions/test/case_1'])
+        ret, report = self.rehearse('evolutions/test/case_2')
+        self.assertEqual(ret, 0)
+        self.assertEqual((report['downs'], report['ups']), ([], [2, 3]))
+        self.assertEqual([ (s['stage'], s['direction'])
+                           for s in report['stages'] ], [(2, 'ups'), (3, 'ups')])
+        self.assertGreaterEqual(report['peak_growth'], 0)
+
+        ret, report = self.rehearse('evolutions/test/case_11')
+        self.assertEqual(ret, 1)
+        self.assertIn('no_such_table', report['error'])
+
+        # Target and directory left as they were
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['r.db', 'report.json'])
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM evolutions')
+                             .fetchone()[0], 1)
+        finally:
+            conn.close()
+
+
+# Fleet mode, using sqlite databases
+class TestFleet(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.targets = path.join(self.tmp_dir, 'targets.txt')
+        self.report = path.join(self.tmp_dir, 'report.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_fleet(self, ev_dir, urls):
+        with open(self.targets, 'w') as f:
+            f.write('# Fleet targets\n')
+            for url in urls:
+                f.write(url + ' "" ""\n')
+        ret = subprocess.call(['./evolutions/evolutions.py',
+                               '--fleet=' + self.targets, ev_dir,
+                               '--jobs=2', '--report=' + self.report])
+        with open(self.report) as f:
+            return ret, json.load(f)
+
+    def test_fleet(self):
+        urls = [ 'sqlite:' + path.join(self.tmp_dir, 'db%d.db' % i)
+                 for i in range(3) ]
+        ret, report = self.run_fleet('evolutions/test/case_2', urls[0:1])
+        self.assertEqual(ret, 0)
+        ret, report = self.run_fleet('evolutions/test/case_3', urls)
+        self.assertEqual(ret, 0)
+        self.assertEqual([ (r['downs'], r['ups']) for r in report['targets'] ],
+                         [(3, 4), (0, 4), (0, 4)])
+        self.assertEqual(len(set(r['plan'] for r in report['targets'])), 2)
+
+        # One failure fails the whole run, but others still evolved
+        ret, report = self.run_fleet('evolutions/test/case_7',
+                                     urls + ['sqlite:/no/such/dir/x.db'])
+        self.assertEqual(ret, 1)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual([ r['ok'] for r in report['targets'] ],
+                         [True, True, True, False])
+
+
+# Clones of evolved template database, using sqlite
+class TestTemplateDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_clones(self):
+        import sqlite3
+        from evolutions.evolutions import TemplateDatabase
+        template = TemplateDatabase('sqlite:' + path.join(self.tmp_dir, 't.db'),
+                                    '', '', 'evolutions/test/case_2')
+        urls = [ template.clone(name) for name in ('gw0', 'gw1') ]
+        self.assertEqual(urls[0], 'sqlite:' + path.join(self.tmp_dir,
+                                                        't_gw0.db'))
+        key = template.key
+        self.assertEqual(template.prepare(), key)
+
+        def count(url):
+            conn = sqlite3.connect(url[len('sqlite:'):])
+            try:
+                return conn.execute('SELECT COUNT(*) FROM soup').fetchone()[0]
+            finally:
+                conn.close()
+        conn = sqlite3.connect(urls[0][len('sqlite:'):])
+        conn.execute('DELETE FROM soup')
+        conn.commit()
+        conn.close()
+        self.assertEqual([ count(url) for url in urls ], [0, 4])
+        template.reset('gw0')
+        self.assertEqual(count(urls[0]), 4)
+
+        # Template evolved again when evolutions change
+        template.ev_dir = 'evolutions/test/case_3'
+        self.assertNotEqual(template.prepare(), key)
+        template.drop('gw1')
+        self.assertFalse(path.exists(urls[1][len('sqlite:'):]))
+
+
+# In-process library API, using sqlite
+class TestLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = path.join(self.tmp_dir, 'lib.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_connection(self):
+        import sqlite3
+        from evolutions.evolutions import run_evolutions
+        conn = sqlite3.connect(self.db_file)
+        try:
+            result = run_evolutions('evolutions/test/case_2', conn=conn)
+            self.assertEqual((result.stages, result.downs, result.ups),
+                             (3, [], [1, 2, 3]))
+            result = run_evolutions('evolutions/test/case_3', conn=conn)
+            self.assertEqual((result.downs, result.ups), ([3, 2, 1],
+                                                          [1, 2, 3, 4]))
+            self.assertIn('evolve', result.metrics.phases)
+            self.assertTrue(run_evolutions('evolutions/test/case_3',
+                                           conn=conn).up_to_date)
+            # Connection left open, with its own settings
+            self.assertEqual(conn.isolation_level, '')
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM soup')
+                             .fetchone()[0], 5)
+            self.assertRaises(Exception, lambda: run_evolutions(
+                'evolutions/test/case_2', conn=conn, prod_mode=True))
+            # Snapshots need client tools, so a URL, except on sqlite
+            self.assertRaises(Exception, lambda: run_evolutions(
+                'evolutions/test/case_3', conn=conn, db_type='postgresql',
+                snapshot_cache=self.tmp_dir))
+        finally:
+            conn.close()
+
+    def test_connection_db_name(self):
+        import sqlite3
+        from evolutions.evolutions import connection_db_name, wrap_connection
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.assertEqual(connection_db_name(wrap_connection(conn)),
+                             path.realpath(self.db_file))
+        finally:
+            conn.close()
+
+    def test_factory_async(self):
+        import asyncio, sqlite3
+        from evolutions.evolutions import run_evolutions_async
+        result = asyncio.run(run_evolutions_async(
+            'evolutions/test/case_2',
+            connect=lambda: sqlite3.connect(self.db_file)))
+        self.assertEqual(result.ups, [1, 2, 3])
+
+    def test_no_logging_setup(self):
+        output = subprocess.check_output([
+            sys.executable, '-c', 'import logging, sys; sys.path.append(".");'
+            ' import evolutions.evolutions; print(logging.getLogger().handlers)'])
+        self.assertEqual(output.strip(), b'[]')
+
+
+# Benchmark harness runs (at minimal scale)
+class TestBenchmark(unittest.TestCase):
+
+    def test_benchmark(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            out = path.join(tmp_dir, 'bench.json')
+            args = ['./evolutions/test/benchmark.py', '--stages=5',
+                    '--size=200', '--repeat=1']
+            subprocess.check_call(args + ['--out=' + out],
+                                  stdout=subprocess.DEVNULL)
+            with open(out) as f:
+                results = json.load(f)['results']
+            self.assertIn('evolve_changed', results)
+            # Huge tolerance, just checking comparison works
+            subprocess.check_call(args + ['--compare=' + out,
+                                          '--tolerance=1000'],
+                                  stdout=subprocess.DEVNULL)
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
 if __name__ == '__main__':
     unittest.main()